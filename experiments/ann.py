@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+from metrics.contrastscore import ContrastScore
+from collections import defaultdict
+from tabulate import tabulate
+from metrics.utils.dataset import DatasetLoader
+from time import time
+import logging
+
+language_pairs = [("de", "en"), ("ru", "en"), ("zh", "en")]
+index_types = [("Flat", "", False), ("IVF64,Flat", "nprobe=8", False), ("HNSW32", "efSearch=64", False),
+        ("IVF64,PQ16", "nprobe=8", False), ("Flat", "", True)]
+
+def ann_tests(source_lang, target_lang):
+    scorer = ContrastScore(source_language=source_lang, target_language=target_lang)
+    parallel_src, parallel_tgt = DatasetLoader(source_lang, target_lang).load("parallel")
+    results = defaultdict(list)
+
+    for index_type, search_params, joint in index_types:
+        scorer.knn_index, scorer.knn_params, scorer.knn_joint, start = index_type, search_params, joint, time()
+        precision = scorer.precision(parallel_src, parallel_tgt)
+        duration = time() - start
+        logging.info(f"Index: {index_type}, Parameters: {search_params}, Joint: {joint}, Precision@1: {precision}, Time: {duration}")
+        results["index"].append(index_type)
+        results["parameters"].append(search_params)
+        results["joint"].append(joint)
+        results["precision@1"].append(round(100 * precision, 2))
+        results["seconds"].append(round(duration, 2))
+
+    return f"{source_lang}-{target_lang}-ann", tabulate(results, headers="keys")
+
+logging.basicConfig(level=logging.INFO, datefmt="%m-%d %H:%M", format="%(asctime)s %(levelname)-8s %(message)s")
+for source_lang, target_lang in language_pairs:
+    print(*ann_tests(source_lang, target_lang), sep="\n")
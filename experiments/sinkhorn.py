@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+from metrics.xmoverscore import XMoverBertAlignScore
+from collections import defaultdict
+from tabulate import tabulate
+from numpy import abs as nabs, array, argsort, corrcoef
+from metrics.utils.dataset import DatasetLoader
+from time import time
+import logging
+
+language_pairs = [("de", "en"), ("en", "de"), ("ru", "en"), ("zh", "en")]
+
+def correlation(model_scores, ref_scores):
+    ref_ranks, ranks = argsort(ref_scores).argsort(), argsort(model_scores).argsort()
+    return corrcoef(ref_scores, model_scores)[0, 1], corrcoef(ref_ranks, ranks)[0, 1]
+
+def sinkhorn_tests(source_lang, target_lang):
+    scorer = XMoverBertAlignScore()
+    eval_src, eval_system, eval_scores = DatasetLoader(source_lang, target_lang).load("scored")
+    results, scores = defaultdict(list), dict()
+
+    for solver in ("emd", "sinkhorn"):
+        scorer.wmd_solver, start = solver, time()
+        scores[solver] = array(scorer.score(eval_src, eval_system))
+        duration = time() - start
+        pearson, spearman = correlation(scores[solver], eval_scores)
+        logging.info(f"Solver: {solver}, Pearson: {pearson}, Spearman: {spearman}, Time: {duration}")
+        results["solver"].append(solver)
+        results["pearson"].append(round(100 * pearson, 2))
+        results["spearman"].append(round(100 * spearman, 2))
+        results["seconds"].append(round(duration, 2))
+
+    difference = nabs(scores["emd"] - scores["sinkhorn"])
+    summary = {
+        "mean abs. difference": [difference.mean()],
+        "max abs. difference": [difference.max()],
+        "pearson (emd vs. sinkhorn)": [corrcoef(scores["emd"], scores["sinkhorn"])[0, 1]],
+    }
+
+    return f"{source_lang}-{target_lang}-sinkhorn", tabulate(results, headers="keys"), tabulate(summary, headers="keys")
+
+logging.basicConfig(level=logging.INFO, datefmt="%m-%d %H:%M", format="%(asctime)s %(levelname)-8s %(message)s")
+for source_lang, target_lang in language_pairs:
+    print(*sinkhorn_tests(source_lang, target_lang), sep="\n")
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+from metrics.utils.knn import merge_topk, score_candidates
+from collections import defaultdict
+from tabulate import tabulate
+from time import time
+import numpy as np
+import logging
+
+k, num_shards = 5, 4
+
+def merge_loop(sims, inds, k):
+    aux = np.argsort(-sims, axis=1)
+    sim_batch = np.zeros((sims.shape[0], k), dtype=np.float32)
+    ind_batch = np.zeros((sims.shape[0], k), dtype=np.int64)
+    for i in range(sims.shape[0]):
+        for j in range(k):
+            sim_batch[i, j] = sims[i, aux[i, j]]
+            ind_batch[i, j] = inds[i, aux[i, j]]
+    return sim_batch, ind_batch
+
+def score_loop(sim_mat, candidate_inds, fwd_mean, bwd_mean):
+    scores = np.zeros(candidate_inds.shape)
+    for i in range(scores.shape[0]):
+        for j in range(scores.shape[1]):
+            scores[i, j] = sim_mat[i, j] / ((fwd_mean[i] + bwd_mean[int(candidate_inds[i, j])]) / 2)
+    return scores
+
+def timed(func, *args):
+    start = time()
+    result = func(*args)
+    return result, time() - start
+
+def topk_tests(size):
+    rng, results = np.random.default_rng(0), defaultdict(list)
+    sims = rng.random((size, num_shards * k), dtype=np.float32)
+    inds = rng.integers(0, size, (size, num_shards * k))
+
+    (loop_sims, loop_inds), loop_time = timed(merge_loop, sims, inds, k)
+    (vec_sims, vec_inds), vec_time = timed(merge_topk, sims, inds, k)
+    assert np.array_equal(loop_sims, vec_sims)
+    results["operation"].append("merge")
+    results["loop seconds"].append(round(loop_time, 2))
+    results["vectorized seconds"].append(round(vec_time, 2))
+    results["speedup"].append(round(loop_time / vec_time, 1))
+
+    fwd_mean, bwd_mean = vec_sims.mean(axis=1), rng.random(size, dtype=np.float32)
+    loop_scores, loop_time = timed(score_loop, vec_sims, vec_inds, fwd_mean, bwd_mean)
+    vec_scores, vec_time = timed(score_candidates, vec_sims, vec_inds, fwd_mean, bwd_mean)
+    assert np.allclose(loop_scores, vec_scores)
+    results["operation"].append("score_candidates")
+    results["loop seconds"].append(round(loop_time, 2))
+    results["vectorized seconds"].append(round(vec_time, 2))
+    results["speedup"].append(round(loop_time / vec_time, 1))
+
+    logging.info(f"Finished top-k benchmark for {size} sentences.")
+    return f"topk-{size}-{k}-{num_shards}", tabulate(results, headers="keys")
+
+logging.basicConfig(level=logging.INFO, datefmt="%m-%d %H:%M", format="%(asctime)s %(levelname)-8s %(message)s")
+for size in (10000, 100000, 1000000, 5000000):
+    print(*topk_tests(size), sep="\n")
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from numpy import corrcoef, argsort
 from torch.nn.functional import mse_loss, l1_loss
-from torch import FloatTensor
+from torch import FloatTensor, sum as tsum
 
 class CommonScore(ABC):
     @abstractmethod
@@ -21,6 +21,17 @@ class CommonScore(ABC):
         masks.
         """
 
+    def _embed_pooled(self, source_sents, target_sents, same_language=False):
+        """
+        This method receives a list of sentences in the source language and a
+        list of sentences in the target language as parameters and returns
+        their mean-pooled embeddings. Subclasses can override it to avoid
+        holding the token embeddings of all sentences in memory at once.
+        """
+        src_embeddings, _, _, src_mask, tgt_embeddings, _, _, tgt_mask = self._embed(source_sents, target_sents,
+                same_language)
+        return tsum(src_embeddings * src_mask, 1) / tsum(src_mask, 1), tsum(tgt_embeddings * tgt_mask, 1) / tsum(tgt_mask, 1)
+
     @abstractmethod
     def score():
         """
@@ -6,6 +6,7 @@ from torch.nn import CrossEntropyLoss, Module, DataParallel
 from torch.nn.functional import cosine_similarity
 from math import ceil
 from .utils.knn import ratio_margin_align
+from .utils.cache import EmbeddingCache
 from .common import CommonScore
 from .utils.env import DATADIR
 from .utils.wmd import word_mover_score
@@ -63,7 +64,11 @@ class ContrastScore(CommonScore):
         mine_batch_size = 5000000,
         train_size = 100000,
         k = 5,
-        suffix = None
+        suffix = None,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False
     ):
         self.model_name = model_name
         self.train_batch_size = train_batch_size
@@ -75,6 +80,10 @@ class ContrastScore(CommonScore):
         self.mine_batch_size = mine_batch_size
         self.train_size = train_size
         self.k = k
+        self.knn_index = knn_index
+        self.knn_params = knn_params
+        self.knn_joint = knn_joint
+        self.embedding_cache = EmbeddingCache() if cache_embeddings else None
         self.cache_dir = join(DATADIR, "contrastive-learning",
             f"{'-'.join(sorted([source_language, target_language]))}-{basename(model_name)}")
         self.suffix = suffix
@@ -92,6 +101,11 @@ class ContrastScore(CommonScore):
         return path
 
     def _embed(self, source_sents, target_sents):
+        if self.embedding_cache is not None:
+            encode = lambda sents: self.model.encode(sents, convert_to_tensor=True).cpu()
+            return (
+                self.embedding_cache.embed(source_sents, encode, self.model),
+                self.embedding_cache.embed(target_sents, encode, self.model))
         return (
             self.model.encode(source_sents, convert_to_tensor=True).cpu(),
             self.model.encode(target_sents, convert_to_tensor=True).cpu())
@@ -99,7 +113,8 @@ class ContrastScore(CommonScore):
     def align(self, source_sents, target_sents):
         source_embeddings, target_embeddings = self._embed(source_sents, target_sents)
         indeces, scores = ratio_margin_align(source_embeddings, target_embeddings, self.k,
-                self.knn_batch_size, self.device)
+                self.knn_batch_size, self.device, index_type=self.knn_index,
+                search_params=self.knn_params, joint=self.knn_joint)
 
         sent_pairs = [(source_sents[src_idx], target_sents[tgt_idx]) for src_idx, tgt_idx in indeces]
         return sent_pairs, scores
@@ -108,7 +123,7 @@ class ContrastScore(CommonScore):
         source_embeddings, target_embeddings = self._embed(source_sents, target_sents)
         return cosine_similarity(source_embeddings, target_embeddings)
 
-    def mine(self, source_sents, target_sents, mine_size, overwrite=True):
+    def mine(self, source_sents, target_sents, mine_size, overwrite=True, cache_index=False):
         logging.info("Mining pseudo parallel data.")
         file_path = join(self.path, "mined-sentence-pairs.txt")
         pairs, scores, batch, batch_size = list(), list(), 0, self.mine_batch_size
@@ -119,7 +134,8 @@ class ContrastScore(CommonScore):
                 source_embeddings, target_embeddings = self._embed(batch_src, batch_tgt)
                 logging.info("Mining pseudo parallel data with Ratio Margin function.")
                 batch_pairs, batch_scores = ratio_margin_align(source_embeddings, target_embeddings, self.k,
-                        self.knn_batch_size, self.device)
+                        self.knn_batch_size, self.device, cache_index, self.knn_index,
+                        self.knn_params, self.knn_joint)
                 del source_embeddings, target_embeddings
                 pairs.extend([(src + batch, tgt + batch) for src, tgt in batch_pairs]), scores.extend(batch_scores)
                 batch += batch_size
@@ -141,14 +157,14 @@ class ContrastScore(CommonScore):
                 sents.append(line.decode().strip().split("\t"))
             return sents
 
-    def train(self, source_sents, target_sents, aligned=False, finetune=False, overwrite=True):
+    def train(self, source_sents, target_sents, aligned=False, finetune=False, overwrite=True, cache_index=False):
         if not isfile(join(self.path, 'config.json')) or overwrite:
             # Convert train sentences to sentence pairs
             if aligned:
                 train_data = [InputExample(texts=[s, t]) for s, t in zip(source_sents, target_sents)]
             else:
                 train_data = [InputExample(texts=[s, t]) for s, t in self.mine(source_sents, target_sents, self.train_size,
-                    overwrite=overwrite)]
+                    overwrite=overwrite, cache_index=cache_index)]
 
             # DataLoader to batch your data
             train_dataloader = DataLoader(train_data, batch_size=self.train_batch_size, shuffle=True)
@@ -187,6 +203,12 @@ class XLMoverScore(ContrastScore):
             lm_model_name="gpt2",
             use_lm=False,
             lm_weights=[0.9, 0.1],
+            wmd_solver="emd",
+            lm_batch_size=None,
+            lm_stride=None,
+            sinkhorn_reg=0.01,
+            sinkhorn_iterations=100,
+            sinkhorn_batch_size=256,
             **kwargs
         ):
         """
@@ -194,6 +216,17 @@ class XLMoverScore(ContrastScore):
         n_gram           - n-gram size of word mover's distance
         suffix_filter    - filter embeddings of word suffixes (original XLMoverScore
             does this, but it doesn't make sense for SentencePiece-based Models)
+        wmd_solver       - "emd" solves the exact transportation problem for each
+            sentence pair, "sinkhorn" approximates it for whole batches at once
+        lm_batch_size    - score hypotheses with the language model in padded batches
+            of this size instead of one at a time
+        lm_stride        - evaluate hypotheses longer than the context of the language
+            model with a sliding window of this stride instead of truncating them
+        sinkhorn_reg     - entropic regularization of the "sinkhorn" solver, smaller
+            values approximate "emd" more closely but need more iterations
+        sinkhorn_iterations - number of iterations of the "sinkhorn" solver
+        sinkhorn_batch_size - number of sentence pairs the "sinkhorn" solver scores
+            at once
         """
         super().__init__(**kwargs)
         self.embed_batch_size = embed_batch_size
@@ -202,6 +235,12 @@ class XLMoverScore(ContrastScore):
         self.lm_model_name = lm_model_name
         self.use_lm = use_lm
         self.lm_weights = lm_weights
+        self.wmd_solver = wmd_solver
+        self.sinkhorn_reg = sinkhorn_reg
+        self.sinkhorn_iterations = sinkhorn_iterations
+        self.sinkhorn_batch_size = sinkhorn_batch_size
+        self.lm_batch_size = lm_batch_size
+        self.lm_stride = lm_stride
 
     #Override
     def score(self, source_sents, target_sents):
@@ -229,10 +268,11 @@ class XLMoverScore(ContrastScore):
                 tgt_embeddings.extend(embedding_model(input_ids=batch_tgt_ids, attention_mask=batch_tgt_mask)['last_hidden_state'].cpu())
 
         wmd_scores = word_mover_score((torch.stack(src_embeddings), src_idf, src_tokens), (torch.stack(tgt_embeddings), tgt_idf, tgt_tokens),
-                self.n_gram, True, self.suffix_filter)
+                self.n_gram, True, self.suffix_filter, self.wmd_solver, self.device, self.sinkhorn_reg,
+                self.sinkhorn_iterations, self.sinkhorn_batch_size)
 
         if self.use_lm:
-            lm_scores = lm_perplexity(target_sents, self.device, self.lm_model_name)
+            lm_scores = lm_perplexity(target_sents, self.device, self.lm_model_name, self.lm_batch_size, self.lm_stride)
             return (self.lm_weights[0] * torch.tensor(wmd_scores) + self.lm_weights[1] * torch.tensor(lm_scores)).tolist()
         else:
             return wmd_scores
@@ -7,6 +7,7 @@ from torch.nn.functional import cosine_similarity
 from torch import from_numpy
 from .common import CommonScore
 from .utils.knn import ratio_margin_align
+from .utils.cache import EmbeddingCache
 from .utils.env import DATADIR
 from .utils.language import LangDetect
 from .utils.nmt import language2mBART
@@ -34,7 +35,11 @@ class DistilScore(CommonScore):
         mine_batch_size = 5000000,
         train_size = 200000,
         k = 5,
-        suffix = None
+        suffix = None,
+        knn_index = "Flat",                 # FAISS index type for nearest neighbor search
+        knn_params = "",                    # Parameters for approximate search, e.g. nprobe=64
+        knn_joint = False,                  # Search both directions of ratio margin in a single pass
+        cache_embeddings = False            # Cache sentence embeddings in memory and on disk
     ):
         self.teacher_model_name = teacher_model_name
         self.student_model_name = student_model_name
@@ -47,6 +52,10 @@ class DistilScore(CommonScore):
         self.mine_batch_size = mine_batch_size
         self.train_size = train_size
         self.k = k
+        self.knn_index = knn_index
+        self.knn_params = knn_params
+        self.knn_joint = knn_joint
+        self.embedding_cache = EmbeddingCache() if cache_embeddings else None
         self.cache_dir = join(DATADIR, "distillation",
             f"{'-'.join(sorted([source_language, target_language]))}-{basename(teacher_model_name)}-{basename(student_model_name)}")
         self.suffix = suffix
@@ -83,12 +92,17 @@ class DistilScore(CommonScore):
         return path
 
     def _embed(self, source_sents, target_sents):
+        if self.embedding_cache is not None:
+            return (
+                self.embedding_cache.embed(source_sents, self.model.encode, self.model).numpy(),
+                self.embedding_cache.embed(target_sents, self.model.encode, self.model).numpy())
         return self.model.encode(source_sents), self.model.encode(target_sents)
 
     def align(self, source_sents, target_sents):
         source_embeddings, target_embeddings = self._embed(source_sents, target_sents)
         indeces, scores = ratio_margin_align(from_numpy(source_embeddings), from_numpy(target_embeddings), self.k,
-                self.knn_batch_size, self.device)
+                self.knn_batch_size, self.device, index_type=self.knn_index,
+                search_params=self.knn_params, joint=self.knn_joint)
 
         sent_pairs = [(source_sents[src_idx], target_sents[tgt_idx]) for src_idx, tgt_idx in indeces]
         return sent_pairs, scores
@@ -97,7 +111,7 @@ class DistilScore(CommonScore):
         source_embeddings, target_embeddings = self._embed(source_sents, target_sents)
         return cosine_similarity(from_numpy(source_embeddings), from_numpy(target_embeddings))
 
-    def mine(self, source_sents, target_sents, overwrite=True):
+    def mine(self, source_sents, target_sents, overwrite=True, cache_index=False):
         logging.info("Mining pseudo parallel data.")
         file_path = join(self.path, "mined-sentence-pairs.txt")
         pairs, scores, batch, batch_size = list(), list(), 0, self.mine_batch_size
@@ -108,7 +122,8 @@ class DistilScore(CommonScore):
                 source_embeddings, target_embeddings = self._embed(batch_src, batch_tgt)
                 logging.info("Mining pseudo parallel data with Ratio Margin function.")
                 batch_pairs, batch_scores = ratio_margin_align(from_numpy(source_embeddings),
-                        from_numpy(target_embeddings), self.k, self.knn_batch_size, self.device)
+                        from_numpy(target_embeddings), self.k, self.knn_batch_size, self.device, cache_index,
+                        self.knn_index, self.knn_params, self.knn_joint)
                 del source_embeddings, target_embeddings
                 pairs.extend([(src + batch, tgt + batch) for src, tgt in batch_pairs]), scores.extend(batch_scores)
                 batch += batch_size
@@ -123,7 +138,8 @@ class DistilScore(CommonScore):
                         break
         return file_path
 
-    def train(self, source_sents, target_sents, dev_source_sents=None, dev_target_sents=None, aligned=False, overwrite=True):
+    def train(self, source_sents, target_sents, dev_source_sents=None, dev_target_sents=None, aligned=False, overwrite=True,
+            cache_index=False):
         if not isfile(join(self.path, 'config.json')) or overwrite:
             # Train a new model to avoid overfitting
             new_model = self.load_student(self.student_model_name)
@@ -139,7 +155,7 @@ class DistilScore(CommonScore):
                 train_data.add_dataset(zip(source_sents, target_sents), max_sentences=self.train_size,
                         max_sentence_length=None)
             else:
-                train_data.load_data(self.mine(source_sents, target_sents, overwrite=overwrite),
+                train_data.load_data(self.mine(source_sents, target_sents, overwrite=overwrite, cache_index=cache_index),
                         max_sentences=self.train_size, max_sentence_length=None)
 
             train_dataloader = DataLoader(train_data, shuffle=True, batch_size=self.train_batch_size)
@@ -3,32 +3,30 @@ from .xmoverscore import BertEmbed
 from .utils.knn import ratio_margin_align
 from torch.nn.functional import cosine_similarity
 from torch.cuda import is_available as cuda_is_available
-from torch import sum as tsum
 import logging
 
 class RatioMarginAlign(CommonScore):
-    def __init__(self, device, k, knn_batch_size):
+    def __init__(self, device, k, knn_batch_size, knn_index="Flat", knn_params="", knn_joint=False):
         self.device = device
         self.k = k
         self.knn_batch_size = knn_batch_size
+        self.knn_index = knn_index
+        self.knn_params = knn_params
+        self.knn_joint = knn_joint
 
     def align(self, source_sents, target_sents):
-        src_embeddings, _, _, src_mask, tgt_embeddings, _, _, tgt_mask = self._embed(
-                source_sents, target_sents)
+        source_sent_embeddings, target_sent_embeddings = self._embed_pooled(source_sents, target_sents)
 
         logging.info("Computing scores with Ratio Margin algorithm.")
-        source_sent_embeddings = tsum(src_embeddings * src_mask, 1) / tsum(src_mask, 1)
-        target_sent_embeddings = tsum(tgt_embeddings * tgt_mask, 1) / tsum(tgt_mask, 1)
         indeces, scores = ratio_margin_align(source_sent_embeddings, target_sent_embeddings, self.k,
-                self.knn_batch_size, self.device)
+                self.knn_batch_size, self.device, index_type=self.knn_index,
+                search_params=self.knn_params, joint=self.knn_joint)
 
         sent_pairs = [(source_sents[src_idx], target_sents[tgt_idx]) for src_idx, tgt_idx in indeces]
         return sent_pairs, scores
 
     def score(self, source_sents, target_sents):
-        src_embeddings, _, _, src_mask, tgt_embeddings, _, _, tgt_mask = self._embed(source_sents, target_sents)
-        source_sent_embeddings = tsum(src_embeddings * src_mask, 1) / tsum(src_mask, 1)
-        target_sent_embeddings = tsum(tgt_embeddings * tgt_mask, 1) / tsum(tgt_mask, 1)
+        source_sent_embeddings, target_sent_embeddings = self._embed_pooled(source_sents, target_sents)
         scores = cosine_similarity(source_sent_embeddings, target_sent_embeddings)
         return scores
 
@@ -43,7 +41,10 @@ class RatioMarginBertAlignScore(RatioMarginAlign, BertEmbed):
         k = 20,
         remap_size = 2000,
         embed_batch_size = 128,
-        knn_batch_size = 1000000
+        knn_batch_size = 1000000,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False
     ):
-        RatioMarginAlign.__init__(self, device, k, knn_batch_size)
-        BertEmbed.__init__(self, model_name, mapping, device, do_lower_case, remap_size, embed_batch_size, alignment)
+        RatioMarginAlign.__init__(self, device, k, knn_batch_size, knn_index, knn_params, knn_joint)
+        BertEmbed.__init__(self, model_name, None, mapping, device, do_lower_case, embed_batch_size)
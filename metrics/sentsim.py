@@ -7,6 +7,7 @@ from torch.nn import CosineSimilarity
 from torch.cuda import is_available as cuda_is_available
 from datasets import load_metric
 from .utils.knn import ratio_margin_align
+from .utils.cache import EmbeddingCache
 from .utils.env import DATADIR
 from .common import CommonScore
 import torch
@@ -29,6 +30,10 @@ class SentSim(CommonScore):
         knn_batch_size = 1000000,
         mine_batch_size = 5000000,
         k = 5,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
     ):
         if use_wmd:
             self.tokenizer, self.word_model = self.get_WMD_Model(wordemb_model)
@@ -41,8 +46,17 @@ class SentSim(CommonScore):
         self.mine_batch_size = mine_batch_size
         self.device = device
         self.k = k
+        self.knn_index = knn_index
+        self.knn_params = knn_params
+        self.knn_joint = knn_joint
+        self.embedding_cache = EmbeddingCache() if cache_embeddings else None
 
     def _embed(self, source_sents, target_sents):
+        if self.embedding_cache is not None:
+            encode = lambda sents: self.sent_model.encode(sents, convert_to_tensor=True).cpu()
+            return (
+                self.embedding_cache.embed(source_sents, encode, self.sent_model),
+                self.embedding_cache.embed(target_sents, encode, self.sent_model))
         return (
             self.sent_model.encode(source_sents, convert_to_tensor=True).cpu(),
             self.sent_model.encode(target_sents, convert_to_tensor=True).cpu())
@@ -51,7 +65,8 @@ class SentSim(CommonScore):
         logging.warn("For now SentSim sentence alignment only leverages sentence embeddings.")
         source_embeddings, target_embeddings = self._embed(source_sents, target_sents)
         indeces, scores = ratio_margin_align(source_embeddings, target_embeddings, self.k,
-                self.knn_batch_size, self.device)
+                self.knn_batch_size, self.device, index_type=self.knn_index,
+                search_params=self.knn_params, joint=self.knn_joint)
 
         sent_pairs = [(source_sents[src_idx], target_sents[tgt_idx]) for src_idx, tgt_idx in indeces]
         return sent_pairs, scores
@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+from filelock import FileLock
+from hashlib import sha1
+from os import listdir, utime
+from os.path import getmtime, getsize, isdir, isfile, join
+from pathlib import Path
+from shutil import rmtree
+from transformers import PreTrainedTokenizerBase
+from weakref import ref
+from .env import DATADIR
+import numpy as np
+import torch
+
+def fingerprint(*objects):
+    """
+    Hashes the content of models, tensors, arrays and (nested) containers of
+    them, so that e.g. a model gets a different fingerprint after training.
+    Tokenizers are identified by their name and whether they lowercase text.
+    """
+    checksum = sha1()
+    def update(obj):
+        if isinstance(obj, torch.nn.Module):
+            update(obj.state_dict())
+            # tokenizers aren't part of the state dict, e.g. those of sentence-transformers
+            update([(module.tokenizer, getattr(module, "do_lower_case", None)) for module in obj.modules()
+                if isinstance(getattr(module, "tokenizer", None), PreTrainedTokenizerBase)])
+        elif isinstance(obj, PreTrainedTokenizerBase):
+            update((type(obj).__name__, obj.name_or_path, getattr(obj, "do_lower_case",
+                obj.init_kwargs.get("do_lower_case"))))
+        elif torch.is_tensor(obj):
+            checksum.update(obj.detach().cpu().numpy().tobytes())
+        elif isinstance(obj, np.ndarray):
+            checksum.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, Mapping):
+            for key, value in obj.items():
+                update(key)
+                update(value)
+        elif isinstance(obj, (list, tuple)):
+            for item in obj:
+                update(item)
+        else:
+            checksum.update(f"{type(obj).__name__}:{obj}".encode())
+    for obj in objects:
+        update(obj)
+    return checksum.hexdigest()
+
+def _reference(obj):
+    try:
+        return ref(obj)
+    except TypeError:
+        return lambda: obj
+
+def _versions(obj):
+    # in-place modifications of tensors (e.g. optimizer steps) increase their version counters
+    if isinstance(obj, torch.nn.Module):
+        return tuple(tensor._version for tensor in obj.state_dict(keep_vars=True).values())
+    elif torch.is_tensor(obj):
+        return obj._version
+
+class EmbeddingCache():
+    """
+    Content-addressed cache for sentence embeddings, which are looked up by the
+    fingerprint of the model that created them, the pooling method and a hash
+    of the sentence. Recently used embeddings are kept in an in-memory LRU
+    cache. When persist is True, all embeddings are additionally appended to
+    files in DATADIR, which are memory-mapped for lookups, so that they can be
+    reused across processes. Writes are guarded by file locks and once the
+    files exceed disk_capacity bytes, the least recently used models are
+    evicted.
+    """
+    def __init__(self, capacity=100000, persist=True, disk_capacity=10 * 1024**3):
+        self.capacity = capacity
+        self.persist = persist
+        self.disk_capacity = disk_capacity
+        self.memory = OrderedDict()
+        self.fingerprints = list()
+        self.disk = dict()
+
+    def invalidate(self):
+        """
+        Forgets the fingerprints of all models, which is only required when
+        a model is modified in a way that its version counters can't detect,
+        e.g. through the data attribute of its parameters.
+        """
+        self.fingerprints = list()
+
+    def _fingerprint(self, identity):
+        # fingerprinting large models is expensive, so remember the last few model objects and their versions
+        versions = tuple(map(_versions, identity))
+        for references, old_versions, key in self.fingerprints:
+            if (len(references) == len(identity) and all(a() is b for a, b in zip(references, identity))
+                    and old_versions == versions):
+                return key
+        key = fingerprint(*identity)
+        self.fingerprints = [(tuple(map(_reference, identity)), versions, key)] + self.fingerprints[:7]
+        return key
+
+    @staticmethod
+    def _lock(key):
+        # lock files live outside of the directories, so that they survive eviction
+        Path(DATADIR, "embeddings").mkdir(parents=True, exist_ok=True)
+        return FileLock(join(DATADIR, "embeddings", f"{key}.lock"))
+
+    @staticmethod
+    def _read(path):
+        """
+        Returns the hashes of all complete rows of a tier, the dimension of its
+        vectors and the size of the index in bytes. Rows which were only partly
+        appended, e.g. because a process crashed, are ignored.
+        """
+        if not isfile(join(path, "dim.txt")):
+            return list(), None, 0
+        with open(join(path, "dim.txt")) as f:
+            dim = int(f.read())
+        rows = getsize(join(path, "vectors.f32")) // (4 * dim) if isfile(join(path, "vectors.f32")) else 0
+        hashes, size = list(), 0
+        if isfile(join(path, "index.txt")):
+            with open(join(path, "index.txt"), "rb") as f:
+                for line in f:
+                    # vectors are appended before the index, so index lines without a vector can't be complete
+                    if not line.endswith(b"\n") or len(hashes) >= rows:
+                        break
+                    hashes.append(line[:-1].decode())
+                    size += len(line)
+        return hashes, dim, size
+
+    def _load(self, key):
+        path = join(DATADIR, "embeddings", key)
+        if key not in self.disk or self.disk[key]["vectors"] is None:
+            with self._lock(key):
+                Path(path).mkdir(parents=True, exist_ok=True)
+                utime(path)
+                hashes, dim, _ = self._read(path)
+                # other processes only append, so the first rows stay valid after the lock is released
+                vectors = None
+                if len(hashes) > 0:
+                    vectors = np.memmap(join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(len(hashes), dim))
+            self.disk[key] = {"path": path, "index": {text_hash: row for row, text_hash in enumerate(hashes)},
+                "vectors": vectors}
+        return self.disk[key]
+
+    def _evict(self, key):
+        root, sizes, mtimes = join(DATADIR, "embeddings"), dict(), dict()
+        for other in listdir(root):
+            if isdir(join(root, other)):
+                sizes[other] = sum(getsize(join(root, other, name)) for name in listdir(join(root, other)))
+                mtimes[other] = getmtime(join(root, other))
+        # the current model is evicted last, so that it can keep its embeddings if it fits on its own
+        for other in sorted(sizes, key=lambda other: (other == key, mtimes[other])):
+            if sum(sizes.values()) <= self.disk_capacity:
+                break
+            with self._lock(other):
+                rmtree(join(root, other), ignore_errors=True)
+            self.disk.pop(other, None)
+            del sizes[other]
+
+    def _store(self, key, hashes, embeddings):
+        path, embeddings = join(DATADIR, "embeddings", key), np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock(key):
+            Path(path).mkdir(parents=True, exist_ok=True)
+            stored, dim, size = self._read(path)
+            if dim is None:
+                dim = embeddings.shape[1]
+                with open(join(path, "dim.txt"), "w") as f:
+                    f.write(str(dim))
+            # other processes may have stored some of the sentences since they were looked up
+            known = set(stored)
+            rows = [row for row, text_hash in enumerate(hashes) if text_hash not in known]
+            if len(rows) > 0:
+                with open(join(path, "vectors.f32"), "ab") as vectors, open(join(path, "index.txt"), "ab") as index:
+                    # discard the remains of interrupted appends, so that vectors and index stay aligned
+                    vectors.truncate(4 * dim * len(stored))
+                    index.truncate(size)
+                    vectors.write(embeddings[rows].tobytes())
+                    vectors.flush()
+                    index.writelines(f"{hashes[row]}\n".encode() for row in rows)
+        # the next load also picks up rows which were appended by other processes
+        self.disk.pop(key, None)
+        self._evict(key)
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def embed(self, sentences, embed_fn, *identity, pooling="mean"):
+        """
+        Returns the embeddings of sentences as a float tensor and calls
+        embed_fn only for those sentences which are not cached yet. The
+        remaining arguments identify the model, e.g. the model itself and
+        optionally a projection matrix.
+        """
+        if len(sentences) == 0:
+            return torch.as_tensor(embed_fn(sentences))
+        key = self._fingerprint(identity + (pooling,))
+        hashes = [sha1(sent.encode()).hexdigest() for sent in sentences]
+        tier = self._load(key) if self.persist else None
+        embeddings, missing = [None] * len(sentences), dict()
+
+        for idx, text_hash in enumerate(hashes):
+            if (key, text_hash) in self.memory:
+                embeddings[idx] = self.memory[(key, text_hash)]
+                self.memory.move_to_end((key, text_hash))
+            elif tier is not None and text_hash in tier["index"]:
+                embeddings[idx] = np.array(tier["vectors"][tier["index"][text_hash]])
+                self._remember((key, text_hash), embeddings[idx])
+            else:
+                missing.setdefault(text_hash, sentences[idx])
+
+        if missing:
+            new_embeddings = torch.as_tensor(embed_fn(list(missing.values()))).cpu().float().numpy()
+            if self.persist:
+                self._store(key, list(missing.keys()), new_embeddings)
+            for text_hash, embedding in zip(missing.keys(), new_embeddings):
+                self._remember((key, text_hash), embedding)
+            lookup = dict(zip(missing.keys(), new_embeddings))
+            embeddings = [lookup[text_hash] if embedding is None else embedding
+                    for text_hash, embedding in zip(hashes, embeddings)]
+
+        return torch.from_numpy(np.stack(embeddings))
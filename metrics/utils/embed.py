@@ -1,13 +1,16 @@
 import torch
-from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
+import logging
 from collections import defaultdict
+from os import remove
 from os.path import join, isfile
+from pathlib import Path
+from hashlib import sha1
 from shutil import copyfileobj
 from urllib.request import urlretrieve
 from gzip import open as gopen
 from .language import WordTokenizer
 from .vecmap.map_embeddings import vecmap
+from .vecmap.embeddings import convert, save, load
 from .env import DATADIR
 
 fasttext_url = "https://dl.fbaipublicfiles.com/fasttext/vectors-crawl/"
@@ -33,58 +36,159 @@ def collate_idf(arr, tokenize, numericalize, max_len):
 
     return padded, padded_idf, mask, tokens
 
-def bert_embed(all_sens, batch_size, model, tokenizer, device):
+def length_batches(lengths, batch_size, max_tokens=None):
+    """
+    Groups sentences of similar length into batches of at most batch_size
+    sentences and, if max_tokens is given, at most max_tokens (padded) tokens.
+    Yields tensors of indices into lengths, starting with the longest batch.
+    """
+    order = torch.argsort(torch.as_tensor(lengths), descending=True)
+    start = 0
+    while start < len(order):
+        # the first sentence of a batch is the longest, so it determines the padded size
+        size = batch_size if max_tokens is None else max(1, min(batch_size, max_tokens // lengths[order[start]]))
+        yield order[start:start + size]
+        start += size
+
+def _embed_batches(padded_sens, mask, batch_size, model, device, max_tokens=None):
+    lengths = mask.sum(1)
+    model.eval()
+    for indices in length_batches(lengths.tolist(), batch_size, max_tokens):
+        batch_len = lengths[indices].max().item()
+        batch_mask = mask[indices, :batch_len].to(device)
+        with torch.no_grad():
+            batch_embeddings = model(padded_sens[indices, :batch_len].to(device), batch_mask)["last_hidden_state"]
+        yield indices, batch_embeddings, batch_mask
+
+def bert_embed_batches(all_sens, batch_size, model, tokenizer, device, max_tokens=None):
+    """
+    Generator version of bert_embed, which yields the indices of the sentences
+    in each batch together with their token embeddings and padding mask on
+    device, so that only a single batch of token embeddings exists at a time.
+    """
+    if len(all_sens) > 0:
+        padded_sens, _, mask, _ = collate_idf(all_sens, tokenizer.tokenize, tokenizer.convert_tokens_to_ids,
+                tokenizer.max_len_single_sentence)
+        for indices, embeddings, batch_mask in _embed_batches(padded_sens, mask, batch_size, model, device, max_tokens):
+            yield indices, embeddings, batch_mask.unsqueeze(-1)
+
+def bert_pool(all_sens, batch_size, model, tokenizer, device, max_tokens=None):
+    pooled = torch.empty(len(all_sens), model.config.hidden_size)
+    for indices, embeddings, mask in bert_embed_batches(all_sens, batch_size, model, tokenizer, device, max_tokens):
+        pooled[indices] = (torch.sum(embeddings * mask, 1) / torch.sum(mask, 1)).cpu()
+    return pooled
+
+def bert_embed(all_sens, batch_size, model, tokenizer, device, max_tokens=None, ragged=False):
+    """
+    Embeds sentences in batches of similar length to reduce padding. When
+    ragged is True, embeddings and idf weights are returned as lists of
+    unpadded tensors and the mask is replaced by the sentence lengths.
+    """
     if len(all_sens) == 0:
+        if ragged:
+            return list(), list(), list(), torch.empty(0, dtype=torch.long)
         return torch.empty(0, 0, 768), torch.empty(0, 0, 1), list(), torch.empty(0, 0, 1)
     padded_sens, padded_idf, mask, tokens = collate_idf(all_sens, tokenizer.tokenize, tokenizer.convert_tokens_to_ids,
             tokenizer.max_len_single_sentence)
-    data = TensorDataset(padded_sens, mask)
-    sampler = SequentialSampler(data)
-    dataloader = DataLoader(data, sampler=sampler, batch_size=batch_size)
-    all_embeddings = torch.zeros((len(all_sens), mask.shape[1], model.config.hidden_size))
-
-    model.eval()
-    with torch.no_grad():
-        for batch_index, (batch_padded_sens, batch_mask) in enumerate(dataloader):
-            pos = batch_index * batch_size
-            batch_padded_sens = batch_padded_sens.to(device)
-            batch_mask = batch_mask.to(device)
-            all_embeddings[pos:pos + len(batch_mask)] = model(batch_padded_sens, batch_mask)["last_hidden_state"].cpu()
+    lengths = mask.sum(1)
+    if ragged:
+        all_embeddings = [None] * len(all_sens)
+    else:
+        all_embeddings = torch.zeros((len(all_sens), mask.shape[1], model.config.hidden_size))
+
+    for indices, batch_embeddings, _ in _embed_batches(padded_sens, mask, batch_size, model, device, max_tokens):
+        batch_embeddings = batch_embeddings.cpu()
+        if ragged:
+            for index, embeddings in zip(indices.tolist(), batch_embeddings):
+                all_embeddings[index] = embeddings[:lengths[index]]
+        else:
+            all_embeddings[indices, :batch_embeddings.shape[1]] = batch_embeddings
+
+    if ragged:
+        return all_embeddings, [idf[:length] for idf, length in zip(padded_idf, lengths)], tokens, lengths
     return all_embeddings, padded_idf, tokens, mask.unsqueeze(-1)
 
-def map_multilingual_embeddings(src_lang, tgt_lang, batch_size, device):
-    src_emb = get_embeddings_file(src_lang)
-    tgt_emb = get_embeddings_file(tgt_lang)
-
-    arguments = ['--batch_size', str(batch_size), '--unsupervised', src_emb, tgt_emb]
-    if "cuda" in device:
-        arguments.insert(0, '--cuda')
-    return vecmap(arguments)
+def map_multilingual_embeddings(src_lang, tgt_lang, batch_size, device, vocab_size=None):
+    """
+    Maps fasttext embeddings of two languages into a shared space with vecmap.
+    The mapped embeddings are persisted in DATADIR, keyed by the language pair
+    and the vecmap arguments, and memory-mapped in later runs.
+    """
+    arguments = ['--unsupervised']
+    if vocab_size is not None:
+        arguments[:0] = ['--max_vocab', str(vocab_size)]
+
+    # batch size and device don't affect the mapping, so they are not part of the key
+    path = join(DATADIR, "vecmap", f"{src_lang}-{tgt_lang}-{sha1(' '.join(arguments).encode()).hexdigest()[:16]}")
+    if not isfile(join(path, "tgt.npy")):
+        # interrupted runs resume self-learning from their last checkpoint
+        arguments = ['--batch_size', str(batch_size), '--checkpoint', join(path, "checkpoint.npz"), '--resume'] + arguments
+        if "cuda" in device:
+            arguments.insert(0, '--cuda')
+        Path(path).mkdir(parents=True, exist_ok=True)
+        src_emb, tgt_emb = get_embeddings_file(src_lang), get_embeddings_file(tgt_lang)
+        src_words, xw, tgt_words, zw = vecmap(arguments + [src_emb, tgt_emb])
+        save(src_words, xw, join(path, "src.npy"))
+        save(tgt_words, zw, join(path, "tgt.npy"))
+        if isfile(join(path, "checkpoint.npz")):
+            remove(join(path, "checkpoint.npz"))
+    else:
+        logging.info(f"Loading mapped embeddings from {path}.")
+
+    return (WordEmbeddings(*load(join(path, "src.npy"), mmap=True), join(path, "src")),
+        WordEmbeddings(*load(join(path, "tgt.npy"), mmap=True), join(path, "tgt")))
+
+class WordEmbeddings():
+    """
+    Word embeddings stored in a single matrix with an index from words to
+    rows. Unknown words are embedded as zero vectors. The key identifies the
+    embeddings, e.g. for caching.
+    """
+    def __init__(self, words, matrix, key=None):
+        self.index = {word: row for row, word in enumerate(words)}
+        self.matrix = torch.from_numpy(matrix)
+        self.key = key
+
+    def rows(self, words):
+        return [self.index.get(word, -1) for word in words]
+
+    def lookup(self, rows):
+        return self.matrix[rows.clamp(min=0)] * (rows >= 0).unsqueeze(-1)
 
 def get_embeddings_file(lang_id):
     filename = f"cc.{lang_id}.300.vec"
     gz_filename = filename + ".gz"
+    npy_filename = f"cc.{lang_id}.300.npy"
+
+    if isfile(join(DATADIR, npy_filename)):
+        return join(DATADIR, npy_filename)
 
-    if isfile(join(DATADIR, filename)):
-        return join(DATADIR, filename)
+    if not isfile(join(DATADIR, filename)):
+        urlretrieve(join(fasttext_url, gz_filename), join(DATADIR, gz_filename))
 
-    urlretrieve(join(fasttext_url, gz_filename), join(DATADIR, gz_filename))
+        with gopen(join(DATADIR, gz_filename), 'rb') as f:
+            with open(join(DATADIR, filename), 'wb') as f_out:
+                copyfileobj(f, f_out)
 
-    with gopen(join(DATADIR, gz_filename), 'rb') as f:
-        with open(join(DATADIR, filename), 'wb') as f_out:
-            copyfileobj(f, f_out)
+    # parsing the text format is slow, so convert it once to a binary format which can be memory-mapped
+    logging.info(f"Converting {filename} to binary format.")
+    with open(join(DATADIR, filename), encoding='utf-8', errors='surrogateescape') as f:
+        convert(f, join(DATADIR, npy_filename))
 
-    return join(DATADIR, filename)
+    return join(DATADIR, npy_filename)
 
 def vecmap_embed(all_sents, lang_dict, lang):
-    tokens, idf_weights, embeddings = list(), list(), list()
+    if len(all_sents) == 0:
+        return torch.empty(0, 0, 300), torch.empty(0, 0), list(), torch.empty(0, 0, 1)
+    tokens, idf_weights, rows = list(), list(), list()
     with WordTokenizer(lang) as tokenize:
         for sent in all_sents:
             tokens.append([word for word in tokenize(sent)])
             idf_weights.append([1] * len(tokens[-1]))
-            embeddings.append(torch.stack([lang_dict[word] for word in tokens[-1]]))
+            rows.append(lang_dict.rows(tokens[-1]))
 
     idf_weights, mask = padding(idf_weights, 0, dtype=torch.float)
-    embeddings = pad_sequence(embeddings, batch_first=True)
+    # padding and unknown words both map to zero vectors
+    embeddings = lang_dict.lookup(padding(rows, -1)[0])
 
     return embeddings, idf_weights, tokens, mask.unsqueeze(-1)
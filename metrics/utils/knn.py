@@ -1,72 +1,189 @@
-from faiss import IndexFlatL2, IndexFlatIP, index_cpu_to_all_gpus, normalize_L2 
+from faiss import (IndexFlatL2, IndexFlatIP, ParameterSpace, METRIC_INNER_PRODUCT, METRIC_L2, index_cpu_to_all_gpus,
+        index_factory, normalize_L2, read_index, write_index)
+from hashlib import sha1
+from os.path import isfile, join
+from pathlib import Path
+from torch.nn.functional import normalize
+from .env import DATADIR
 import numpy as np
+import torch
+
+class ShardedIndex():
+    """
+    Nearest neighbor index over shards of target_data, which can be searched by
+    arbitrarily many source batches. Each shard is built only once and kept in
+    memory when keep is True. When cache is True shards are also written to
+    DATADIR, so that later indices over the same data can skip building them.
+
+    By default shards are searched exhaustively. Approximate search can be
+    enabled by passing a FAISS index_factory string as index_type (e.g.
+    "IVF4096,Flat", "HNSW32" or "IVF4096,PQ64"), whose recall/speed trade-off
+    can be tuned with search_params (e.g. "nprobe=64" or "efSearch=128").
+    """
+    def __init__(self, target_data, batch_size, device, use_cosine=False, cache=False, keep=True, index_type="Flat",
+            search_params=""):
+        self.target_data = target_data
+        self.device = device
+        self.use_cosine = use_cosine
+        self.cache = cache
+        self.keep = keep
+        self.index_type = index_type
+        self.search_params = search_params
+        self.bounds = np.cumsum([0] + [len(shard) for shard in np.array_split(target_data,
+            np.ceil(len(target_data) / batch_size))])
+        self.shards = dict()
+        if cache:
+            checksum = sha1(np.ascontiguousarray(target_data))
+            checksum.update(f"{use_cosine}-{batch_size}-{index_type}".encode())
+            self.cache_dir = join(DATADIR, "knn", checksum.hexdigest())
+            Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def shard(self, index):
+        if index in self.shards:
+            return self.shards[index]
+
+        file_path = join(self.cache_dir, f"shard-{index}.index") if self.cache else None
+        if self.cache and isfile(file_path):
+            idx = read_index(file_path)
+        else:
+            dim, y_batch = self.target_data.shape[-1], self.target_data[self.bounds[index]:self.bounds[index + 1]]
+            if self.index_type == "Flat":
+                idx = IndexFlatIP(dim) if self.use_cosine else IndexFlatL2(dim)
+            else:
+                idx = index_factory(dim, self.index_type, METRIC_INNER_PRODUCT if self.use_cosine else METRIC_L2)
+                idx.train(y_batch)
+            idx.add(y_batch)
+            if self.cache:
+                write_index(idx, file_path)
+        if self.search_params:
+            ParameterSpace().set_index_parameters(idx, self.search_params)
+        if self.keep:
+            self.shards[index] = idx
+        return idx
+
+    def search(self, source_data, k, batch_size):
+        x_batches = np.array_split(source_data, np.ceil(len(source_data) / batch_size))
+        sims, inds = [None] * len(x_batches), [None] * len(x_batches)
+
+        # iterate over target shards in the outer loop, so that each shard is loaded only once
+        for index in range(len(self)):
+            idx = self.shard(index)
+            # HNSW indices have no GPU implementation
+            if self.device != 'cpu' and "HNSW" not in self.index_type:
+                idx = index_cpu_to_all_gpus(idx)
+            neighbor_size = min(k, idx.ntotal)
+            for x_index, x_batch in enumerate(x_batches):
+                bsim, bind = idx.search(x_batch, neighbor_size)
+                # approximate indices return -1 when they find less than neighbor_size neighbors, which are
+                # given the worst possible score so that they are ranked last
+                bsim[bind < 0] = -np.inf if self.use_cosine else np.inf
+                bind = np.where(bind < 0, bind, bind + self.bounds[index])
+                # merge with the neighbors of previous shards right away, so that at most 2k candidates are kept per row
+                if sims[x_index] is not None:
+                    bsim, bind = np.concatenate((sims[x_index], bsim), axis=1), np.concatenate((inds[x_index], bind), axis=1)
+                sims[x_index], inds[x_index] = merge_topk(bsim, bind, k, self.use_cosine)
+            del idx
+
+        return np.concatenate(sims, axis=0), np.concatenate(inds, axis=0)
+
+def merge_topk(sims, inds, k, largest=True):
+    """
+    Select the k best neighbors per row of candidates gathered from multiple
+    shards, i.e. the largest similarities or the smallest distances.
+    """
+    keys, k = -sims if largest else sims, min(k, sims.shape[1])
+    top = np.argpartition(keys, k - 1, axis=1)[:, :k] if k < sims.shape[1] else np.indices(sims.shape)[1]
+    top = np.take_along_axis(top, np.take_along_axis(keys, top, axis=1).argsort(axis=1), axis=1)
+    return np.take_along_axis(sims, top, axis=1), np.take_along_axis(inds, top, axis=1)
 
 # Adopted from https://github.com/pytorch/fairseq/blob/master/examples/criss/mining/mine.py
-def knn_sharded(source_data, target_data, k, batch_size, device, use_cosine=False):
+def knn_sharded(source_data, target_data, k, batch_size, device, use_cosine=False, cache=False, index_type="Flat",
+        search_params=""):
     if use_cosine:
         normalize_L2(source_data)
         normalize_L2(target_data)
-    sims = []
-    inds = []
-    dim = source_data.shape[-1]
-    xfrom = 0
-
-    for x_batch in np.array_split(source_data, np.ceil(len(source_data) / batch_size)):
-        yfrom = 0
-        bsims, binds = [], []
-        for y_batch in np.array_split(target_data, np.ceil(len(target_data) / batch_size)):
-            neighbor_size = min(k, y_batch.shape[0])
-            idx = IndexFlatIP(dim) if use_cosine else IndexFlatL2(dim)
-            if device != 'cpu':
-                idx = index_cpu_to_all_gpus(idx)
-            idx.add(y_batch)
-            bsim, bind = idx.search(x_batch, neighbor_size)
+    index = ShardedIndex(target_data, batch_size, device, use_cosine, cache, False, index_type, search_params)
+    return index.search(source_data, k, batch_size)
 
-            bsims.append(bsim)
-            binds.append(bind + yfrom)
-            yfrom += y_batch.shape[0]
-            del idx
-            del y_batch
-        bsims = np.concatenate(bsims, axis=1)
-        binds = np.concatenate(binds, axis=1)
-        aux = np.argsort(-bsims, axis=1)
-        sim_batch = np.zeros((x_batch.shape[0], k), dtype=np.float32)
-        ind_batch = np.zeros((x_batch.shape[0], k), dtype=np.int64)
-        for i in range(x_batch.shape[0]):
-            for j in range(k):
-                sim_batch[i, j] = bsims[i, aux[i, j]]
-                ind_batch[i, j] = binds[i, aux[i, j]]
-        sims.append(sim_batch)
-        inds.append(ind_batch)
-        xfrom += x_batch.shape[0]
-        del x_batch
-    sim = np.concatenate(sims, axis=0)
-    ind = np.concatenate(inds, axis=0)
-    return sim, ind
+def knn_mean(sims, inds):
+    """
+    Mean similarity of the neighbors of each row, ignoring missing neighbors (-1).
+    """
+    found = inds >= 0
+    return np.where(found, sims, 0).sum(axis=1) / np.maximum(found.sum(axis=1), 1)
 
 def score_candidates(sim_mat, candidate_inds, fwd_mean, bwd_mean):
-    scores = np.zeros(candidate_inds.shape)
-    for i in range(scores.shape[0]):
-        for j in range(scores.shape[1]):
-            k = int(candidate_inds[i, j])
-            scores[i, j] = sim_mat[i, j] / ((fwd_mean[i] + bwd_mean[k]) / 2)
-    return scores
-
-def ratio_margin_align(source_data, target_data, k, batch_size, device):
-    src2tgt_sim, src2tgt_ind = knn_sharded(source_data.numpy(), target_data.numpy(), k, batch_size, device, True)
-    tgt2src_sim, _ = knn_sharded(target_data.numpy(), source_data.numpy(), k, batch_size, device)
-
-    src2tgt_mean = src2tgt_sim.mean(axis=1)
-    tgt2src_mean = tgt2src_sim.mean(axis=1)
+    # missing candidates (-1) must not index bwd_mean, they can never be the best candidate
+    found = candidate_inds >= 0
+    scores = sim_mat / ((np.expand_dims(fwd_mean, 1) + bwd_mean[np.where(found, candidate_inds, 0)]) / 2)
+    return np.where(found, scores, -np.inf)
+
+def _merge_topk(sims, inds, new_sims, new_inds):
+    sims, top = torch.cat((sims, new_sims), 1).topk(sims.shape[1], dim=1)
+    return sims, torch.cat((inds, new_inds), 1).gather(1, top)
+
+def joint_knn(source_data, target_data, k, device, tile_size=8192):
+    """
+    Exact cosine kNN search in both directions with a single pass over the
+    tiled similarity matrix, where each tile updates the top-k of its rows
+    (source to target) and of its columns (target to source).
+    """
+    source_data, target_data = normalize(source_data.float(), dim=1), normalize(target_data.float(), dim=1)
+    bwd_sims = torch.full((len(target_data), k), float("-inf"), device=device)
+    bwd_inds = torch.full((len(target_data), k), -1, device=device)
+    fwd_sims, fwd_inds = list(), list()
+
+    with torch.no_grad():
+        for x_start in range(0, len(source_data), tile_size):
+            x_tile = source_data[x_start:x_start + tile_size].to(device)
+            x_sims = torch.full((len(x_tile), k), float("-inf"), device=device)
+            x_inds = torch.full((len(x_tile), k), -1, device=device)
+            for y_start in range(0, len(target_data), tile_size):
+                y_tile = target_data[y_start:y_start + tile_size].to(device)
+                y_end, sim = y_start + len(y_tile), x_tile @ y_tile.T
+                tile_sims, tile_inds = sim.topk(min(k, sim.shape[1]), dim=1)
+                x_sims, x_inds = _merge_topk(x_sims, x_inds, tile_sims, tile_inds + y_start)
+                tile_sims, tile_inds = sim.T.topk(min(k, sim.shape[0]), dim=1)
+                bwd_sims[y_start:y_end], bwd_inds[y_start:y_end] = _merge_topk(bwd_sims[y_start:y_end],
+                        bwd_inds[y_start:y_end], tile_sims, tile_inds + x_start)
+            fwd_sims.append(x_sims.cpu())
+            fwd_inds.append(x_inds.cpu())
+
+    # like faiss only return as many neighbors as there are data points
+    fwd_k, bwd_k = min(k, len(target_data)), min(k, len(source_data))
+    return (torch.cat(fwd_sims)[:, :fwd_k].numpy(), torch.cat(fwd_inds)[:, :fwd_k].numpy(),
+            bwd_sims[:, :bwd_k].cpu().numpy(), bwd_inds[:, :bwd_k].cpu().numpy())
+
+def ratio_margin_align(source_data, target_data, k, batch_size, device, cache=False, index_type="Flat", search_params="",
+        joint=False):
+    if joint:
+        src2tgt_sim, src2tgt_ind, tgt2src_sim, tgt2src_ind = joint_knn(source_data, target_data, k, device)
+    else:
+        src2tgt_sim, src2tgt_ind = knn_sharded(source_data.numpy(), target_data.numpy(), k, batch_size, device, True,
+                cache, index_type, search_params)
+        tgt2src_sim, tgt2src_ind = knn_sharded(target_data.numpy(), source_data.numpy(), k, batch_size, device, False, cache,
+                index_type, search_params)
+
+    src2tgt_mean = knn_mean(src2tgt_sim, src2tgt_ind)
+    tgt2src_mean = knn_mean(tgt2src_sim, tgt2src_ind)
     fwd_scores = score_candidates(src2tgt_sim, src2tgt_ind, src2tgt_mean, tgt2src_mean)
     fwd_best = src2tgt_ind[np.arange(src2tgt_sim.shape[0]), fwd_scores.argmax(axis=1)]
 
     return np.insert(np.expand_dims(fwd_best, 1), 0, range(len(fwd_best)), 1), fwd_scores.max(axis=1)
 
-def wcd_align(source_data, target_data, k, batch_size, device):
-    squared_scores, indeces = knn_sharded(source_data.numpy(), target_data.numpy(), k, batch_size, device)
+def wcd_align(source_data, target_data, k, batch_size, device, cache=False, index_type="Flat", search_params=""):
+    squared_scores, indeces = knn_sharded(source_data.numpy(), target_data.numpy(), k, batch_size, device, False, cache,
+            index_type, search_params)
     return indeces, np.sqrt(squared_scores)
 
-def cosine_align(source_data, target_data, k, batch_size, device):
-    scores, indeces = knn_sharded(source_data.numpy(), target_data.numpy(), k, batch_size, device, True)
+def cosine_align(source_data, target_data, k, batch_size, device, cache=False, index_type="Flat", search_params="",
+        joint=False):
+    if joint:
+        scores, indeces, _, _ = joint_knn(source_data, target_data, k, device)
+    else:
+        scores, indeces = knn_sharded(source_data.numpy(), target_data.numpy(), k, batch_size, device, True, cache,
+                index_type, search_params)
     return indeces, scores
@@ -1,24 +1,118 @@
 from transformers import AutoModelWithLMHead, AutoTokenizer
-from torch import tensor
+from collections import OrderedDict
+from torch import cat, tensor, inference_mode
+from torch.cuda import empty_cache
+from torch.nn.functional import cross_entropy
+from torch.nn.utils.rnn import pad_sequence
+import logging
 
-def lm_perplexity(hyps, device, name="gpt2"):
+class ModelRegistry():
+    """
+    Process-wide cache of language models and their tokenizers, keyed by model
+    name, tokenizer name and device. When the loaded models need more than
+    max_memory bytes, the least recently used ones are evicted.
+    """
+    def __init__(self, max_memory=4 * 1024**3):
+        self.max_memory = max_memory
+        self.models = OrderedDict()
+
+    @staticmethod
+    def _size(model):
+        return sum(t.numel() * t.element_size() for t in (*model.parameters(), *model.buffers()))
+
+    def memory(self):
+        return sum(self._size(model) for model, _ in self.models.values())
+
+    def get(self, model_name, tokenizer_name, device):
+        key = (model_name, tokenizer_name, str(device))
+        if key not in self.models:
+            logging.info(f"Loading language model {model_name} on device {device}.")
+            model = AutoModelWithLMHead.from_pretrained(model_name).to(device)
+            self.models[key] = model.eval(), AutoTokenizer.from_pretrained(tokenizer_name)
+            # the requested model is always kept, even if it exceeds the limit on its own
+            while self.max_memory is not None and len(self.models) > 1 and self.memory() > self.max_memory:
+                self.evict(*next(iter(self.models)))
+        self.models.move_to_end(key)
+        return self.models[key]
+
+    def evict(self, model_name=None, tokenizer_name=None, device=None):
+        """
+        Evicts all models that match the given arguments, i.e. all models when
+        no arguments are provided.
+        """
+        for key in list(self.models):
+            if all(value is None or value == field for value, field in zip((model_name, tokenizer_name, device), key)):
+                logging.info(f"Evicting language model {key[0]} from device {key[2]}.")
+                del self.models[key]
+                if "cuda" in key[2]:
+                    empty_cache()
+
+lm_registry = ModelRegistry()
+
+def _sliding_perplexity(input_ids, model, device, stride, max_len=1024):
+    """
+    Computes the mean token loss of sequences which are longer than the context
+    of the model. The sequence is processed in chunks of stride tokens and the
+    cached keys and values of the last max_len - stride tokens serve as context
+    for the next chunk, so that overlapping context isn't recomputed.
+    """
+    stride = min(stride, max_len)
+    past, last_logits, losses, context = None, None, list(), max_len - stride
+    for start in range(0, len(input_ids), stride):
+        chunk = input_ids[start:start + stride].to(device)
+        output = model(chunk.unsqueeze(0), past_key_values=past, use_cache=True)
+        if last_logits is None:
+            losses.append(cross_entropy(output.logits[0, :-1], chunk[1:], reduction="none"))
+        else:
+            losses.append(cross_entropy(cat((last_logits, output.logits[0, :-1])), chunk, reduction="none"))
+        last_logits = output.logits[0, -1:]
+        past = tuple(tuple(kv[:, :, max(0, kv.shape[2] - context):] for kv in layer) for layer in output.past_key_values)
+    return -cat(losses).mean().item()
+
+def _batched_perplexity(hyps, model, tokenizer, device, batch_size, stride=None):
+    input_ids = [tensor(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(hyp)[:None if stride else 1024])) for hyp in hyps]
+    # sort hypotheses by length to minimize padding
+    order = sorted((idx for idx, ids in enumerate(input_ids) if 1 < len(ids) <= 1024), key=lambda idx: len(input_ids[idx]))
+    scores = [_sliding_perplexity(ids, model, device, stride) if len(ids) > 1024 else 0 for ids in input_ids]
+
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        batch_ids = pad_sequence([input_ids[idx] for idx in indices], batch_first=True).to(device)
+        mask = pad_sequence([input_ids[idx].new_ones(len(input_ids[idx])) for idx in indices], batch_first=True).to(device)
+        logits = model(batch_ids, attention_mask=mask).logits
+        # mean token loss of each sequence, where each token is predicted from its predecessors
+        losses = cross_entropy(logits[:, :-1].transpose(1, 2), batch_ids[:, 1:], reduction="none") * mask[:, 1:]
+        for idx, loss in zip(indices, (losses.sum(1) / mask[:, 1:].sum(1)).tolist()):
+            scores[idx] = -loss
+
+    return scores
+
+@inference_mode()
+def lm_perplexity(hyps, device, name="gpt2", batch_size=None, stride=None):
+    """
+    Computes the negative mean token loss of each hypothesis. When batch_size
+    is given, hypotheses are sorted by length and scored in padded batches.
+    Hypotheses longer than the context of the model are truncated, unless a
+    stride for sliding window evaluation is given.
+    """
     if name is None:
         return [0] * len(hyps)
 
     # Some models need a special tokenizer, like chinese gpt2, see here:
     # https://huggingface.co/ckiplab/gpt2-base-chinese
     model_name, tokenizer_name = (name, name) if isinstance(name, str) else name
-
-    model = AutoModelWithLMHead.from_pretrained(model_name).to(device)
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    model, tokenizer = lm_registry.get(model_name, tokenizer_name, device)
+    if batch_size is not None:
+        return _batched_perplexity(hyps, model, tokenizer, device, batch_size, stride)
 
     scores = list()
-    model.eval()
     for hyp in hyps:
         tokenize_input = tokenizer.tokenize(hyp)
 
         if len(tokenize_input) <= 1:
             scores.append(0)
+        elif len(tokenize_input) > 1024 and stride is not None:
+            scores.append(_sliding_perplexity(tensor(tokenizer.convert_tokens_to_ids(tokenize_input)), model, device, stride))
         else:
             if len(tokenize_input) > 1024:
                 tokenize_input = tokenize_input[:1024]
@@ -1,12 +1,27 @@
 import numpy as np
+from math import inf
 import torch
 from itertools import chain
-from subprocess import check_output, DEVNULL
+from multiprocessing.pool import ThreadPool
+from subprocess import CalledProcessError, Popen, DEVNULL, PIPE
 from tempfile import NamedTemporaryFile as TempFile
+from time import sleep
 from simalign import SentenceAligner
-from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
+from torch.nn.functional import normalize, one_hot
+from torch.nn.utils.rnn import pad_sequence
 from .env import DATADIR
 
+def encode_layer(model, input_ids, attention_mask, layer):
+    """
+    Runs only the transformer layers of a BERT model up to the given layer and
+    returns its hidden states, which equal model(...)["hidden_states"][layer].
+    """
+    extended_mask = model.get_extended_attention_mask(attention_mask, input_ids.shape, input_ids.device)
+    hidden_state = model.embeddings(input_ids=input_ids)
+    for bert_layer in model.encoder.layer[:layer]:
+        hidden_state = bert_layer(hidden_state, attention_mask=extended_mask)[0]
+    return hidden_state
+
 def convert_sent_to_input(sents, tokenizer, max_seq_length):
     input_ids = []
     mask = []
@@ -45,77 +60,102 @@ def convert_words_to_bpe(sent_pairs, tokenizer):
     return bpe_para, bpe_table
 
 
-def get_aligned_features_avgbpe(sent_pairs, align_pairs, model,
-        tokenizer, batch_size, device, layer=12, max_seq_length=175):
+def _segment_mean(hidden_state, bpe_indices):
+    """
+    Averages the sub-word embeddings of each word, where bpe_indices contains a
+    list of (sentence, sub-word) indices for each word.
+    """
+    segments = torch.tensor([word for word, indices in enumerate(bpe_indices) for _ in indices], device=hidden_state.device)
+    sentences, subwords = torch.tensor([index for indices in bpe_indices for index in indices], device=hidden_state.device).T
+    sums = torch.zeros(len(bpe_indices), hidden_state.shape[-1], device=hidden_state.device)
+    sums.index_add_(0, segments, hidden_state[sentences, subwords])
+    return sums / torch.bincount(segments, minlength=len(bpe_indices)).unsqueeze(-1)
+
+def aligned_feature_batches(sent_pairs, align_pairs, model, tokenizer, batch_size, device, layer=12, max_seq_length=175):
+    """
+    Generator version of get_aligned_features_avgbpe, which yields the averaged
+    embeddings of aligned source and target words batch by batch.
+    """
     bpe_para, bpe_table = convert_words_to_bpe(sent_pairs, tokenizer)
 
     # filter long/empty sentences
-    fltr_src_bpe, fltr_tgt_bpe, fltr_align_pairs, fltr_bpe_table, align_cnt = [], [], [], [], 0
+    fltr_bpe_para, fltr_align_pairs, fltr_bpe_table = [], [], []
     for cnt, (src, tgt) in enumerate(bpe_para):
         if len(src) <= max_seq_length and len(tgt) <= max_seq_length and len(src) > 0 and len(tgt) > 0:
-            fltr_src_bpe.append(src)
-            fltr_tgt_bpe.append(tgt)
+            fltr_bpe_para.append((src, tgt))
             fltr_align_pairs.append(align_pairs[cnt])
             fltr_bpe_table.append(bpe_table[cnt])
-            align_cnt += len(align_pairs[cnt])
-
-    src_input, src_mask = convert_sent_to_input(fltr_src_bpe, tokenizer, max_seq_length)
-    tgt_input, tgt_mask = convert_sent_to_input(fltr_tgt_bpe, tokenizer, max_seq_length)
-
-    src_data = TensorDataset(src_input, src_mask)
-    src_sampler = SequentialSampler(src_data)
-    src_dataloader = DataLoader(src_data, sampler=src_sampler, batch_size=batch_size)
-
-    tgt_data = TensorDataset(tgt_input, tgt_mask)
-    tgt_sampler = SequentialSampler(tgt_data)
-    tgt_dataloader = DataLoader(tgt_data, sampler=tgt_sampler, batch_size=batch_size)
-
-    src_embed = []
-    tgt_embed = []
 
     model.eval()
-    with torch.no_grad():
-        for batch in src_dataloader:
-            input_ids, input_mask = batch
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-
-            hidden_state = model(input_ids, attention_mask=input_mask)["hidden_states"][layer]
-            src_embed.append(hidden_state[:,1:].cpu().numpy()) # remove CLS
-
-    with torch.no_grad():
-        for batch in tgt_dataloader:
-            input_ids, input_mask = batch
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-
-            hidden_state = model(input_ids, attention_mask=input_mask)["hidden_states"][layer]
-            tgt_embed.append(hidden_state[:,1:].cpu().numpy())
-
-    src_embed = np.concatenate(src_embed)
-    tgt_embed = np.concatenate(tgt_embed)
-
-    feature_size = src_embed.shape[2]
-    cnt, src_matrix, tgt_matrix = 0, np.zeros((align_cnt, feature_size)), np.zeros((align_cnt, feature_size))
-    for i, pairs in enumerate(fltr_align_pairs):
-        for a in pairs:
-            if len(fltr_bpe_table[i][0][a[0]]) > 0 and len(fltr_bpe_table[i][1][a[1]]) > 0: # token alignment (0,0)
-                src_word_avg_embed = np.zeros((1, feature_size))
-
-                for j in fltr_bpe_table[i][0][a[0]]:
-                    src_word_avg_embed += src_embed[i][j,:]
-                src_matrix[cnt,:] = src_word_avg_embed / len(fltr_bpe_table[i][0][a[0]])
-
-                tgt_word_avg_embed = np.zeros((1, feature_size))
-                for j in fltr_bpe_table[i][1][a[1]]:
-                    tgt_word_avg_embed += tgt_embed[i][j,:]
-
-                tgt_matrix[cnt,:] = tgt_word_avg_embed / len(fltr_bpe_table[i][1][a[1]])
-                cnt += 1
+    for idx in range(0, len(fltr_bpe_para), batch_size):
+        batch_bpe_para = fltr_bpe_para[idx:idx + batch_size]
+        src_indices, tgt_indices = list(), list()
+        for i, pairs in enumerate(fltr_align_pairs[idx:idx + batch_size]):
+            src_table, tgt_table = fltr_bpe_table[idx + i]
+            for a in pairs:
+                if len(src_table[a[0]]) > 0 and len(tgt_table[a[1]]) > 0: # token alignment (0,0)
+                    src_indices.append([(i, j) for j in src_table[a[0]]])
+                    tgt_indices.append([(i, j) for j in tgt_table[a[1]]])
+        if len(src_indices) == 0:
+            continue
+
+        features = list()
+        for sents, indices in zip(zip(*batch_bpe_para), (src_indices, tgt_indices)):
+            # pad each batch only to its longest sentence
+            input_ids, input_mask = convert_sent_to_input(sents, tokenizer, max(len(sent) for sent in sents))
+            with torch.no_grad():
+                hidden_state = encode_layer(model, input_ids.to(device), input_mask.to(device), layer)
+            features.append(_segment_mean(hidden_state[:, 1:], indices).cpu().numpy()) # remove CLS
 
-    return src_matrix, tgt_matrix
+        yield tuple(features)
 
-def fast_align(sent_pairs, tokenizer, size, max_seq_length=100):
+def get_aligned_features_avgbpe(sent_pairs, align_pairs, model,
+        tokenizer, batch_size, device, layer=12, max_seq_length=175):
+    src_matrix, tgt_matrix = [np.empty((0, model.config.hidden_size))], [np.empty((0, model.config.hidden_size))]
+    for src_batch, tgt_batch in aligned_feature_batches(sent_pairs, align_pairs, model, tokenizer, batch_size, device,
+            layer, max_seq_length):
+        src_matrix.append(src_batch)
+        tgt_matrix.append(tgt_batch)
+
+    return np.concatenate(src_matrix).astype(np.float64), np.concatenate(tgt_matrix).astype(np.float64)
+
+def _fast_align_chunk(tokenized_pairs):
+    with TempFile(dir=DATADIR) as corpus, TempFile(dir=DATADIR) as fwd_file, TempFile(dir=DATADIR) as bwd_file:
+        corpus.writelines(f'{" ".join(src)} ||| {" ".join(tgt)}\n'.lower().encode() for src, tgt in tokenized_pairs)
+        corpus.flush()
+        # forward and backward alignments are independent, so compute them concurrently
+        procs = [Popen(["fast_align", "-i", corpus.name, flags], stdout=file_, stderr=DEVNULL)
+                for file_, flags in ((fwd_file, "-dov"), (bwd_file, "-dovr"))]
+        try:
+            # poll both processes, so that a failure of either is noticed right away
+            while None in [proc.poll() for proc in procs] and not any(proc.returncode for proc in procs):
+                sleep(0.1)
+            for proc in procs:
+                if proc.returncode:
+                    raise CalledProcessError(proc.returncode, proc.args)
+        finally:
+            # don't leave the other process running when one of them fails
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+
+        with Popen(["atools", "-i", fwd_file.name, "-j", bwd_file.name, "-c", "grow-diag-final-and"],
+                stdout=PIPE) as atools:
+            sym_aligned = [[tuple(map(int, pair.split(b"-"))) for pair in line.split()] for line in atools.stdout]
+        if atools.returncode != 0:
+            raise CalledProcessError(atools.returncode, atools.args)
+
+    return sym_aligned
+
+def fast_align(sent_pairs, tokenizer, size, max_seq_length=100, chunk_size=None, num_workers=1):
+    """
+    Aligns words with fast_align and symmetrizes the alignments with atools.
+    When chunk_size is given, the corpus is split into chunks of this many
+    sentence pairs, which are aligned independently by num_workers parallel
+    fast_align processes. This is faster for large corpora, but each chunk
+    only learns from its own sentence pairs.
+    """
     tokenized_pairs = list()
     for source_sent, target_sent in sent_pairs:
         sent1 = tokenizer.basic_tokenizer.tokenize(source_sent)
@@ -127,74 +167,147 @@ def fast_align(sent_pairs, tokenizer, size, max_seq_length=100):
         if len(tokenized_pairs) >= size:
             break
 
-    with TempFile(dir=DATADIR, buffering=0) as fwd_file, TempFile(dir=DATADIR, buffering=0) as bwd_file:
-        for file_, data, flags in ((fwd_file, tokenized_pairs, "-dov"), (bwd_file, tokenized_pairs, "-dovr")):
-            file_.write("\n".join([f'{" ".join(src)} ||| {" ".join(tgt)}'.lower() for src, tgt in data]).encode())
-            asym_aligned = check_output(["fast_align", "-i", file_.name, flags], stderr=DEVNULL)
-            file_.seek(0)
-            file_.truncate()
-            file_.write(asym_aligned)
+    chunk_size = chunk_size or max(1, len(tokenized_pairs))
+    chunks = [tokenized_pairs[idx:idx + chunk_size] for idx in range(0, len(tokenized_pairs), chunk_size)]
+    # the actual work happens in subprocesses, so threads suffice to drive them
+    with ThreadPool(max(1, min(num_workers, len(chunks)))) as pool:
+        sym_aligned = list(chain.from_iterable(pool.imap(_fast_align_chunk, chunks)))
 
-        sym_aligned = check_output(["atools", "-i", fwd_file.name, "-j", bwd_file.name, "-c", "grow-diag-final-and"])
-
-    sym_aligned = [[tuple(map(int, pair.split(b"-"))) for pair in pairs.split()] for pairs in sym_aligned.splitlines()]
     return tokenized_pairs, sym_aligned
 
-def awesome_align(sentpairs, model, tokenizer, size, device, projection=None, max_seq_length=100):
-    tokenized_pairs, alignments = list(), list()
+def awesome_align(sentpairs, model, tokenizer, size, device, projection=None, max_seq_length=100, batch_size=32,
+        align_layer=8, threshold=1e-3):
+    tokenized_pairs, inputs = list(), list()
     for src, tgt in sentpairs:
         sent_src, sent_tgt = tokenizer.basic_tokenizer.tokenize(src), tokenizer.basic_tokenizer.tokenize(tgt)
         if 0 < len(sent_src) <= max_seq_length and 0 < len(sent_tgt) <= max_seq_length:
-            token_src = [tokenizer.tokenize(word) for word in sent_src]
-            token_tgt = [tokenizer.tokenize(word) for word in sent_tgt]
-            wid_src = [tokenizer.convert_tokens_to_ids(x) for x in token_src]
-            wid_tgt = [tokenizer.convert_tokens_to_ids(x) for x in token_tgt]
-            ids_src = tokenizer.prepare_for_model(list(chain(*wid_src)), return_tensors='pt', truncation=True)['input_ids']
-            ids_tgt = tokenizer.prepare_for_model(list(chain(*wid_tgt)), return_tensors='pt', truncation=True)['input_ids']
-            sub2word_map_src = []
-            for i, word_list in enumerate(token_src):
-                sub2word_map_src.extend([i] * len(word_list))
-            sub2word_map_tgt = []
-            for i, word_list in enumerate(token_tgt):
-                sub2word_map_tgt.extend([i] * len(word_list))
-
-            # alignment
-            align_layer = 8
-            threshold = 1e-3
-            model.eval()
-            with torch.no_grad():
-                out_src = model(ids_src.unsqueeze(0).to(device))["hidden_states"][align_layer]
-                out_tgt = model(ids_tgt.unsqueeze(0).to(device))["hidden_states"][align_layer]
-
-                if projection is not None:
-                    projection = projection.to(device)
-                    if projection.ndim == 2: # CLP
-                        out_src = torch.matmul(out_src, projection)
-                    else: # UMD
-                        out_src = out_src - (out_src * projection).sum(2, keepdim=True) * \
-                                projection.repeat(out_src.shape[0], out_src.shape[1], 1)
-
-                dot_prod = torch.matmul(out_src[0, 1:-1].cpu(), out_tgt[0, 1:-1].transpose(-1, -2).cpu())
-
-                softmax_srctgt = torch.nn.Softmax(dim=-1)(dot_prod)
-                softmax_tgtsrc = torch.nn.Softmax(dim=-2)(dot_prod)
-
-                softmax_inter = (softmax_srctgt > threshold)*(softmax_tgtsrc > threshold)
-
-            align_subwords = torch.nonzero(softmax_inter, as_tuple=False)
-            align_words = set()
-            for i, j in align_subwords:
-                align_words.add((sub2word_map_src[i], sub2word_map_tgt[j]))
-
+            pair_inputs = list()
+            for sent in (sent_src, sent_tgt):
+                tokens = [tokenizer.tokenize(word) for word in sent]
+                wids = [tokenizer.convert_tokens_to_ids(x) for x in tokens]
+                ids = tokenizer.prepare_for_model(list(chain(*wids)), truncation=True)['input_ids']
+                sub2word_map = list(chain(*[[i] * len(word_list) for i, word_list in enumerate(tokens)]))
+                pair_inputs.append((torch.tensor(ids), sub2word_map))
             tokenized_pairs.append((sent_src, sent_tgt))
-            alignments.append(list(align_words))
+            inputs.append(pair_inputs)
 
             if len(tokenized_pairs) >= size:
                 break
 
+    if projection is not None:
+        projection = projection.to(device)
+
+    alignments = list()
+    model.eval()
+    for idx in range(0, len(inputs), batch_size):
+        outputs, valid = list(), list()
+        for batch in zip(*inputs[idx:idx + batch_size]):
+            ids = pad_sequence([sent_ids for sent_ids, _ in batch], True, tokenizer.pad_token_id).to(device)
+            lengths = torch.tensor([len(sent_ids) for sent_ids, _ in batch], device=device)
+            with torch.no_grad():
+                out = encode_layer(model, ids, (torch.arange(ids.shape[1], device=device) < lengths[:, None]).long(),
+                        align_layer)
+            # ignore special tokens at the start and end of each sentence
+            outputs.append(out[:, 1:-1])
+            valid.append(torch.arange(ids.shape[1] - 2, device=device) < (lengths[:, None] - 2))
+        (out_src, out_tgt), (valid_src, valid_tgt) = outputs, valid
+
+        if projection is not None:
+            if projection.ndim == 2: # CLP
+                out_src = torch.matmul(out_src, projection)
+            else: # UMD
+                out_src = out_src - (out_src * projection).sum(-1, keepdim=True) * projection
+
+        dot_prod = torch.bmm(out_src, out_tgt.transpose(-1, -2))
+        valid_pairs = valid_src.unsqueeze(-1) & valid_tgt.unsqueeze(-2)
+        dot_prod = dot_prod.masked_fill(~valid_pairs, torch.finfo(dot_prod.dtype).min)
+
+        softmax_srctgt = torch.nn.Softmax(dim=-1)(dot_prod)
+        softmax_tgtsrc = torch.nn.Softmax(dim=-2)(dot_prod)
+        softmax_inter = (softmax_srctgt > threshold) * (softmax_tgtsrc > threshold) * valid_pairs
+
+        align_words = [set() for _ in range(len(softmax_inter))]
+        for b, i, j in torch.nonzero(softmax_inter, as_tuple=False).tolist():
+            (_, sub2word_map_src), (_, sub2word_map_tgt) = inputs[idx + b]
+            align_words[b].add((sub2word_map_src[i], sub2word_map_tgt[j]))
+        alignments.extend(list(words) for words in align_words)
+
     return tokenized_pairs, alignments
 
-def sim_align(sent_pairs, tokenizer, size, device, max_seq_length=100):
+def _iter_max(sim, valid_src, valid_tgt, alpha=0.9):
+    """
+    Vectorized version of the itermax matching of simalign for a batch of
+    padded similarity matrices.
+    """
+    valid = valid_src.unsqueeze(-1) & valid_tgt.unsqueeze(-2)
+    m, n = sim.shape[1:]
+    inter = (one_hot(sim.masked_fill(~valid, -inf).argmax(2), n)
+        * one_hot(sim.masked_fill(~valid, -inf).argmax(1), m).transpose(1, 2) * valid)
+
+    mask_x = 1 - inter.sum(2, keepdim=True).clamp(max=1)
+    mask_y = 1 - inter.sum(1, keepdim=True).clamp(max=1)
+    # only sentences with at least three words and unaligned words on both sides get a second iteration
+    iterate = ((valid_src.sum(1) > 2) & (valid_tgt.sum(1) > 2) & ((mask_x.squeeze(2) * valid_src).sum(1) > 0)
+        & ((mask_y.squeeze(1) * valid_tgt).sum(1) > 0))
+    mask = (alpha * mask_x + alpha * mask_y).clamp(0, 1)
+    mask_zeros = (1 - (1 - mask_x) * (1 - mask_y)) * valid * iterate[:, None, None]
+
+    new_sim = (sim.masked_fill(~valid, 0) * mask).masked_fill(~valid, -inf)
+    new_inter = one_hot(new_sim.argmax(2), n) * one_hot(new_sim.argmax(1), m).transpose(1, 2) * mask_zeros
+    return inter + new_inter
+
+def _truncate_words(words, max_len):
+    # keep only the words (and sub-words) which fit into max_len sub-words
+    truncated, total = list(), 0
+    for word in words:
+        if total >= max_len:
+            break
+        truncated.append(word[:max_len - total])
+        total += len(truncated[-1])
+    return truncated
+
+def _batched_word_aligns(tokenized_pairs, aligner, batch_size):
+    model, tokenizer = aligner.embed_loader.emb_model, aligner.embed_loader.tokenizer
+    subwords, alignments = dict(), list()
+    for idx in range(0, len(tokenized_pairs), batch_size):
+        embeddings, valid = list(), list()
+        for sents in zip(*tokenized_pairs[idx:idx + batch_size]):
+            # the sub-word ids of each word only need to be computed once, long sentences are truncated like in bert_embed
+            words = [_truncate_words([subwords.setdefault(word, tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word)))
+                for word in sent], tokenizer.max_len_single_sentence) for sent in sents]
+            ids = [torch.tensor([tokenizer.cls_token_id, *chain(*sent), tokenizer.sep_token_id]) for sent in words]
+            lengths = torch.tensor([len(sent_ids) for sent_ids in ids], device=aligner.device)
+            ids = pad_sequence(ids, True, tokenizer.pad_token_id).to(aligner.device)
+            with torch.no_grad():
+                hidden_state = encode_layer(model, ids, (torch.arange(ids.shape[1], device=aligner.device)
+                    < lengths[:, None]).long(), aligner.embed_loader.layer)
+
+            indices, offsets = list(), [0]
+            for sent_idx, sent in enumerate(words):
+                for word in sent:
+                    indices.append([(sent_idx, offsets[-1] + pos) for pos in range(len(word))])
+                    offsets[-1] += len(word)
+                offsets.append(0)
+            word_embeddings = _segment_mean(hidden_state[:, 1:], indices).split([len(sent) for sent in words])
+            embeddings.append(normalize(pad_sequence(word_embeddings, True), dim=-1))
+            valid.append(torch.arange(embeddings[-1].shape[1], device=aligner.device)
+                    < torch.tensor([len(sent) for sent in words], device=aligner.device)[:, None])
+
+        (src, tgt), (valid_src, valid_tgt) = embeddings, valid
+        inter = _iter_max((torch.bmm(src, tgt.transpose(1, 2)) + 1) / 2, valid_src, valid_tgt)
+        align_words = [list() for _ in range(len(inter))]
+        for b, i, j in torch.nonzero(inter, as_tuple=False).tolist():
+            align_words[b].append((i, j))
+        alignments.extend(align_words)
+
+    return alignments
+
+def sim_align(sent_pairs, tokenizer, size, device, max_seq_length=100, batch_size=None):
+    """
+    Aligns words with the itermax method of simalign. When batch_size is
+    given, sentences are embedded and matched in batches instead of pair by
+    pair.
+    """
     tokenized_pairs, alignments = list(), list()
     aligner = SentenceAligner(matching_methods="i", token_type="word", device=device)
     for source_sent, target_sent in sent_pairs:
@@ -203,23 +316,60 @@ def sim_align(sent_pairs, tokenizer, size, device, max_seq_length=100):
 
         if 0 < len(sent1) <= max_seq_length and 0 < len(sent2) <= max_seq_length:
             tokenized_pairs.append((sent1, sent2))
-            alignments.append(aligner.get_word_aligns(sent1, sent2)["itermax"])
+            if batch_size is None:
+                alignments.append(aligner.get_word_aligns(sent1, sent2)["itermax"])
 
         if len(tokenized_pairs) >= size:
             break
 
+    if batch_size is not None:
+        alignments = _batched_word_aligns(tokenized_pairs, aligner, batch_size)
+
     return tokenized_pairs, alignments
 
+class AlignedMoments():
+    """
+    Accumulates the cross-covariance and Gram matrices of aligned source and
+    target word embeddings. These are only hidden_size x hidden_size, but
+    suffice to compute CLP and UMD projections, so aligned word pairs can be
+    folded in batch by batch instead of being held in memory all at once.
+    """
+    def __init__(self, hidden_size):
+        self.count = 0
+        self.zx = np.zeros((hidden_size, hidden_size))
+        self.xx = np.zeros((hidden_size, hidden_size))
+        self.diff = np.zeros((hidden_size, hidden_size))
+
+    def update(self, x, z):
+        x, z = np.asarray(x, dtype=np.float64), np.asarray(z, dtype=np.float64)
+        self.count += len(x)
+        self.zx += z.T.dot(x)
+        self.xx += x.T.dot(x)
+        self.diff += (x - z).T.dot(x - z)
+        return self
+
+    def clp(self, orthogonal=True):
+        if orthogonal:
+            u, _, vt = np.linalg.svd(self.zx)
+            w = vt.T.dot(u.T)
+        else:
+            w = np.linalg.inv(self.xx).dot(self.zx.T)
+        return torch.Tensor(w)
+
+    def umd(self):
+        # the first right singular vector of x - z is the top eigenvector of its Gram matrix
+        _, v = np.linalg.eigh(self.diff)
+        return torch.Tensor(v[:, -1])
+
+def get_aligned_moments(sent_pairs, align_pairs, model, tokenizer, batch_size, device, layer=12, max_seq_length=175):
+    moments = AlignedMoments(model.config.hidden_size)
+    for src_batch, tgt_batch in aligned_feature_batches(sent_pairs, align_pairs, model, tokenizer, batch_size, device,
+            layer, max_seq_length):
+        moments.update(src_batch, tgt_batch)
+    return moments
+
 def clp(x, z, orthogonal=True):
-    if orthogonal:
-        u, _, vt = np.linalg.svd(z.T.dot(x))
-        w = vt.T.dot(u.T)
-    else:
-        x_pseudoinv = np.linalg.inv(x.T.dot(x)).dot(x.T)
-        w = x_pseudoinv.dot(z)
-    return torch.Tensor(w)
+    return AlignedMoments(x.shape[1]).update(x, z).clp(orthogonal)
 
 def umd(x, z):
-    *_, v = np.linalg.svd(x - z)
-    v_b = v[0]
-    return torch.Tensor(v_b)
+    return AlignedMoments(x.shape[1]).update(x, z).umd()
@@ -16,6 +16,7 @@
 from .cupy_utils import *
 
 import numpy as np
+import os
 
 
 def read(file, threshold=0, vocabulary=None, dtype='float'):
@@ -35,6 +36,53 @@ def read(file, threshold=0, vocabulary=None, dtype='float'):
     return (words, matrix) if vocabulary is None else (words, np.array(matrix, dtype=dtype))
 
 
+def convert(file, path):
+    """
+    Converts embeddings in text format to a binary float32 matrix in numpy
+    format at path and a vocabulary file with one word per line next to it.
+    """
+    count, dim = map(int, file.readline().split(' '))
+    vocab_path = os.path.splitext(path)[0] + '.vocab'
+    matrix = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype='float32', shape=(count, dim))
+    with open(vocab_path + '.tmp', 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as vocab:
+        for i in range(count):
+            word, vec = file.readline().split(' ', 1)
+            vocab.write(word + '\n')
+            matrix[i] = np.fromstring(vec, sep=' ', dtype='float32')
+    matrix.flush()
+    del matrix
+    # the matrix is moved last, so that its existence signals a complete conversion
+    os.replace(vocab_path + '.tmp', vocab_path)
+    os.replace(path + '.tmp', path)
+
+
+def save(words, matrix, path):
+    """
+    Saves embeddings in the binary format created by convert.
+    """
+    vocab_path = os.path.splitext(path)[0] + '.vocab'
+    with open(vocab_path + '.tmp', 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as vocab:
+        vocab.writelines(word + '\n' for word in words)
+    with open(path + '.tmp', 'wb') as file:
+        np.save(file, asnumpy(matrix))
+    os.replace(vocab_path + '.tmp', vocab_path)
+    os.replace(path + '.tmp', path)
+
+
+def load(path, threshold=0, dtype='float', mmap=False):
+    """
+    Loads embeddings created by convert or save. The matrix is memory-mapped,
+    so that only the first threshold rows are read from disk. With mmap, the
+    memory-mapped (copy-on-write) matrix is returned in its stored dtype
+    instead of an in-memory copy.
+    """
+    matrix = np.load(path, mmap_mode='c' if mmap else 'r')
+    count = len(matrix) if threshold <= 0 else min(threshold, len(matrix))
+    with open(os.path.splitext(path)[0] + '.vocab', encoding='utf-8', errors='surrogateescape', newline='\n') as vocab:
+        words = [vocab.readline()[:-1] for _ in range(count)]
+    return words, matrix[:count] if mmap else np.array(matrix[:count], dtype=dtype)
+
+
 def write(words, matrix, file):
     m = asnumpy(matrix)
     print('%d %d' % m.shape, file=file)
@@ -15,16 +15,22 @@
 
 from  . import embeddings
 from .cupy_utils import *
-from torch import zeros, from_numpy
-from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from contextlib import nullcontext
 
 import argparse
 import collections
 import numpy as np
+import os
 import re
 import sys
 import time
 
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 
 def dropout(m, p):
     if p <= 0.0:
@@ -43,6 +49,10 @@ def topk_mean(m, k, inplace=False):  # TODO Assuming that axis is 1
         return ans
     if not inplace:
         m = xp.array(m)
+    if xp is np:  # partial sort instead of k argmax passes on CPU
+        k = min(k, m.shape[1])
+        m.partition(m.shape[1] - k, axis=1)
+        return m[:, m.shape[1] - k:].mean(axis=1)
     ind0 = xp.arange(n)
     ind1 = xp.empty(n, dtype=int)
     minimum = m.min()
@@ -53,6 +63,54 @@ def topk_mean(m, k, inplace=False):  # TODO Assuming that axis is 1
     return ans / k
 
 
+def cpu_tiles(rows, cols, itemsize, tile_bytes):
+    # similarity tiles of about tile_bytes, which bound the memory of each thread
+    step = max(1, min(rows, tile_bytes // (cols * itemsize)))
+    return [(i, min(i + step, rows)) for i in range(0, rows, step)]
+
+
+def map_tiles(work, tiles, pool):
+    if pool is None:
+        for tile in tiles:
+            work(tile)
+    else:
+        # every thread gets a single-threaded BLAS, so that threads don't oversubscribe the cores
+        with threadpool_limits(limits=1, user_api='blas') if threadpool_limits is not None else nullcontext():
+            pool.map(work, tiles)
+
+
+def cpu_topk_mean(queries, keys, k, pool, tile_bytes):
+    """
+    Mean similarity of each query to its k nearest keys, computed tile by tile
+    in a thread pool.
+    """
+    ans = np.empty(queries.shape[0], dtype=queries.dtype)
+    def work(tile):
+        i, j = tile
+        ans[i:j] = topk_mean(queries[i:j].dot(keys.T), k, inplace=True)
+    map_tiles(work, cpu_tiles(queries.shape[0], keys.shape[0], queries.itemsize, tile_bytes), pool)
+    return ans
+
+
+def cpu_induce(queries, keys, knn_sim, keep_prob, seed, best_sim, indices, pool, tile_bytes):
+    """
+    CPU version of the dictionary induction loop: for each query, stores the
+    highest similarity in best_sim and the index of the nearest key according
+    to CSLS with stochastic dropout in indices, computed tile by tile in a
+    thread pool. The dropout mask of each tile is seeded by seed and its
+    offset, so that results don't depend on scheduling.
+    """
+    def work(tile):
+        i, j = tile
+        sim = queries[i:j].dot(keys.T)
+        sim.max(axis=1, out=best_sim[i:j])
+        sim -= knn_sim/2  # Equivalent to the real CSLS scores for NN
+        if keep_prob < 1.0:
+            sim[np.random.default_rng(seed + (i,)).random(sim.shape, dtype=np.float32) < 1 - keep_prob] = 0
+        sim.argmax(axis=1, out=indices[i:j])
+    map_tiles(work, cpu_tiles(queries.shape[0], keys.shape[0], queries.itemsize, tile_bytes), pool)
+
+
 def vecmap(cmd_args=None):
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Map word embeddings in two languages into a shared space')
@@ -63,6 +121,9 @@ def vecmap(cmd_args=None):
     parser.add_argument('--cuda', action='store_true', help='use cuda (requires cupy)')
     parser.add_argument('--batch_size', default=10000, type=int, help='batch size (defaults to 10000); does not affect results, larger is usually faster but uses more memory')
     parser.add_argument('--seed', type=int, default=0, help='the random seed (defaults to 0)')
+    parser.add_argument('--threads', type=int, default=1, help='number of threads for dictionary induction on CPU, each with a single-threaded BLAS (defaults to 1, i.e. parallelism comes from BLAS)')
+    parser.add_argument('--tile_bytes', type=int, default=32*1024**2, help='size of the similarity tiles for dictionary induction on CPU (defaults to 32MiB)')
+    parser.add_argument('--max_vocab', type=int, default=0, help='only read the top k entries of the input embeddings (defaults to all)')
 
     recommended_group = parser.add_argument_group('recommended settings', 'Recommended settings for different scenarios')
     recommended_type = recommended_group.add_mutually_exclusive_group()
@@ -107,6 +168,11 @@ def vecmap(cmd_args=None):
     self_learning_group.add_argument('--stochastic_multiplier', default=2.0, type=float, help='stochastic dictionary induction multiplier (defaults to 2.0)')
     self_learning_group.add_argument('--stochastic_interval', default=50, type=int, help='stochastic dictionary induction interval (defaults to 50)')
     self_learning_group.add_argument('--log', help='write to a log file in tsv format at each iteration')
+    self_learning_group.add_argument('--checkpoint', metavar='FILE', help='periodically save the self-learning state to this file')
+    self_learning_group.add_argument('--checkpoint_interval', default=10, type=int, help='save a checkpoint every n iterations (defaults to 10)')
+    self_learning_group.add_argument('--resume', action='store_true', help='resume self-learning from the checkpoint file if it exists')
+    self_learning_group.add_argument('--max_iterations', default=0, type=int, help='stop self-learning after n iterations (defaults to no limit)')
+    self_learning_group.add_argument('--max_time', default=0, type=float, help='stop self-learning after n seconds (defaults to no limit)')
     self_learning_group.add_argument('-v', '--verbose', action='store_true', help='write log information to stderr at each iteration')
     args = parser.parse_args(cmd_args)
 
@@ -141,11 +207,20 @@ def vecmap(cmd_args=None):
     elif args.precision == 'fp64':
         dtype = 'float64'
 
+    start_time = time.time()
+
     # Read input embeddings
-    srcfile = open(args.src_input, encoding=args.encoding, errors='surrogateescape')
-    trgfile = open(args.trg_input, encoding=args.encoding, errors='surrogateescape')
-    src_words, x = embeddings.read(srcfile, dtype=dtype)
-    trg_words, z = embeddings.read(trgfile, dtype=dtype)
+    # (binary embeddings in numpy format are memory-mapped)
+    if args.src_input.endswith('.npy'):
+        src_words, x = embeddings.load(args.src_input, threshold=args.max_vocab, dtype=dtype)
+    else:
+        srcfile = open(args.src_input, encoding=args.encoding, errors='surrogateescape')
+        src_words, x = embeddings.read(srcfile, threshold=args.max_vocab, dtype=dtype)
+    if args.trg_input.endswith('.npy'):
+        trg_words, z = embeddings.load(args.trg_input, threshold=args.max_vocab, dtype=dtype)
+    else:
+        trgfile = open(args.trg_input, encoding=args.encoding, errors='surrogateescape')
+        trg_words, z = embeddings.read(trgfile, threshold=args.max_vocab, dtype=dtype)
 
     # NumPy/CuPy management
     if args.cuda:
@@ -170,7 +245,14 @@ def vecmap(cmd_args=None):
     # Build the seed dictionary
     src_indices = []
     trg_indices = []
-    if args.init_unsupervised:
+    checkpoint = None
+    if args.resume and args.checkpoint is not None and os.path.isfile(args.checkpoint):
+        checkpoint = np.load(args.checkpoint, allow_pickle=True)
+        src_indices = xp.asarray(checkpoint['src_indices'])
+        trg_indices = xp.asarray(checkpoint['trg_indices'])
+        if xp is np:
+            np.random.set_state(tuple(checkpoint['random_state']))
+    elif args.init_unsupervised:
         sim_size = min(x.shape[0], z.shape[0]) if args.unsupervised_vocab <= 0 else min(x.shape[0], z.shape[0], args.unsupervised_vocab)
         u, s, vt = xp.linalg.svd(x[:sim_size], full_matrices=False)
         xsim = (u*s).dot(u.T)
@@ -248,8 +330,9 @@ def vecmap(cmd_args=None):
     zw = xp.empty_like(z)
     src_size = x.shape[0] if args.vocabulary_cutoff <= 0 else min(x.shape[0], args.vocabulary_cutoff)
     trg_size = z.shape[0] if args.vocabulary_cutoff <= 0 else min(z.shape[0], args.vocabulary_cutoff)
-    simfwd = xp.empty((args.batch_size, trg_size), dtype=dtype)
-    simbwd = xp.empty((args.batch_size, src_size), dtype=dtype)
+    if xp is not np:  # the CPU path allocates its own tiles
+        simfwd = xp.empty((args.batch_size, trg_size), dtype=dtype)
+        simbwd = xp.empty((args.batch_size, src_size), dtype=dtype)
     if args.validation is not None:
         simval = xp.empty((len(validation.keys()), z.shape[0]), dtype=dtype)
 
@@ -261,12 +344,18 @@ def vecmap(cmd_args=None):
     trg_indices_backward = xp.arange(trg_size)
     knn_sim_fwd = xp.zeros(src_size, dtype=dtype)
     knn_sim_bwd = xp.zeros(trg_size, dtype=dtype)
+    pool = ThreadPool(args.threads) if xp is np and args.threads > 1 else None
+    if pool is not None and threadpool_limits is None:
+        print('WARNING: Install threadpoolctl to avoid oversubscribing the CPU with multithreaded BLAS', file=sys.stderr)
 
     # Training loop
     best_objective = objective = -100.
     it = 1
     last_improvement = 0
     keep_prob = args.stochastic_initial
+    if checkpoint is not None:
+        it, last_improvement = int(checkpoint['it']), int(checkpoint['last_improvement'])
+        keep_prob, best_objective = float(checkpoint['keep_prob']), float(checkpoint['best_objective'])
     t = time.time()
     end = not args.self_learning
     while True:
@@ -278,6 +367,10 @@ def vecmap(cmd_args=None):
             keep_prob = min(1.0, args.stochastic_multiplier*keep_prob)
             last_improvement = it
 
+        # Stop early with the current dictionary when the iteration or time budget is exhausted
+        if (args.max_iterations > 0 and it > args.max_iterations) or (args.max_time > 0 and time.time() - start_time > args.max_time):
+            end = True
+
         # Update the embedding mapping
         if args.orthogonal or not end:  # orthogonal mapping
             u, s, vt = xp.linalg.svd(z[trg_indices].T.dot(x[src_indices]))
@@ -335,7 +428,18 @@ def vecmap(cmd_args=None):
             break
         else:
             # Update the training dictionary
-            if args.direction in ('forward', 'union'):
+            if xp is np:
+                if args.direction in ('forward', 'union'):
+                    if args.csls_neighborhood > 0:
+                        knn_sim_bwd = cpu_topk_mean(zw[:trg_size], xw[:src_size], args.csls_neighborhood, pool, args.tile_bytes)
+                    cpu_induce(xw[:src_size], zw[:trg_size], knn_sim_bwd, keep_prob, (args.seed, it, 0),
+                               best_sim_forward, trg_indices_forward, pool, args.tile_bytes)
+                if args.direction in ('backward', 'union'):
+                    if args.csls_neighborhood > 0:
+                        knn_sim_fwd = cpu_topk_mean(xw[:src_size], zw[:trg_size], args.csls_neighborhood, pool, args.tile_bytes)
+                    cpu_induce(zw[:trg_size], xw[:src_size], knn_sim_fwd, keep_prob, (args.seed, it, 1),
+                               best_sim_backward, src_indices_backward, pool, args.tile_bytes)
+            if xp is not np and args.direction in ('forward', 'union'):
                 if args.csls_neighborhood > 0:
                     for i in range(0, trg_size, simbwd.shape[0]):
                         j = min(i + simbwd.shape[0], trg_size)
@@ -347,7 +451,7 @@ def vecmap(cmd_args=None):
                     simfwd[:j-i].max(axis=1, out=best_sim_forward[i:j])
                     simfwd[:j-i] -= knn_sim_bwd/2  # Equivalent to the real CSLS scores for NN
                     dropout(simfwd[:j-i], 1 - keep_prob).argmax(axis=1, out=trg_indices_forward[i:j])
-            if args.direction in ('backward', 'union'):
+            if xp is not np and args.direction in ('backward', 'union'):
                 if args.csls_neighborhood > 0:
                     for i in range(0, src_size, simfwd.shape[0]):
                         j = min(i + simfwd.shape[0], src_size)
@@ -406,10 +510,18 @@ def vecmap(cmd_args=None):
                 print('{0}\t{1:.6f}\t{2}\t{3:.6f}'.format(it, 100 * objective, val, duration), file=log)
                 log.flush()
 
+            # Checkpointing
+            if args.checkpoint is not None and it % args.checkpoint_interval == 0:
+                with open(args.checkpoint + '.tmp', 'wb') as f:
+                    np.savez(f, src_indices=asnumpy(src_indices), trg_indices=asnumpy(trg_indices), it=it + 1,
+                             last_improvement=last_improvement, keep_prob=keep_prob, best_objective=best_objective,
+                             random_state=np.array(np.random.get_state(), dtype=object))
+                os.replace(args.checkpoint + '.tmp', args.checkpoint)
+
         t = time.time()
         it += 1
 
-    src_dict, tgt_dict = defaultdict(lambda: zeros(300)), defaultdict(lambda: zeros(300))
-    src_dict.update(zip(src_words, from_numpy(asnumpy(xw))))
-    tgt_dict.update(zip(trg_words, from_numpy(asnumpy(zw))))
-    return src_dict, tgt_dict
+    if pool is not None:
+        pool.close()
+
+    return src_words, asnumpy(xw), trg_words, asnumpy(zw)
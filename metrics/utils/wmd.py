@@ -1,7 +1,11 @@
 import numpy as np
 import torch
-from torch.nn.functional import cosine_similarity
+from torch.nn.functional import cosine_similarity, pad
+from torch.nn.utils.rnn import pad_sequence
+from torch.multiprocessing import Pool
 import string
+import atexit
+import logging
 from pyemd import emd
 
 def pairwise_distances(x, y=None):
@@ -36,6 +40,53 @@ def load_ngram(tokens, embedding, idf, n_gram, suffix_filter=True):
     new_a = torch.stack(new_a, 0)
     return new_a, new_idf
 
+def _padded_ngrams(tokens, embeddings, idf, n_gram, suffix_filter=True):
+    seq_len, punctuation = embeddings.shape[1], set(string.punctuation)
+    keep = torch.tensor([[not suffix_filter or (w not in punctuation and '##' not in w) for w in sent[:seq_len]]
+        + [False] * (seq_len - len(sent[:seq_len])) for sent in tokens], dtype=torch.bool).view(len(tokens), seq_len)
+
+    # move filtered tokens to the front of each sequence, while preserving their order
+    order = torch.argsort((~keep).long() * seq_len + torch.arange(seq_len), dim=1)
+    lengths = torch.clamp(keep.sum(1) - n_gram + 1, min=1)
+    idf = (idf * keep).gather(1, order)
+    weighted = (idf.unsqueeze(-1) * embeddings.gather(1, order.unsqueeze(-1).expand(-1, -1, embeddings.shape[-1])))
+
+    # zero padding ensures that sentences with less than n_gram tokens form one n-gram
+    idf_ngrams = pad(idf, (0, n_gram - 1)).unfold(1, n_gram, 1).sum(-1)
+    embedding_ngrams = _safe_divide(pad(weighted, (0, 0, 0, n_gram - 1)).unfold(1, n_gram, 1).sum(-1),
+            idf_ngrams.unsqueeze(-1))
+
+    mask = torch.arange(embedding_ngrams.shape[1]).unsqueeze(0) < lengths.unsqueeze(-1)
+    return embedding_ngrams[mask], idf_ngrams[mask], lengths
+
+def load_ngrams(tokens, embeddings, idf, n_gram, suffix_filter=True, bucket_size=256):
+    """
+    Batched version of load_ngram, which operates on padded embeddings of shape
+    (batch, seq, dim) and idf weights of shape (batch, seq), or on ragged
+    embeddings and idf weights, i.e., lists of unpadded tensors. Returns the
+    n-gram embeddings and idf weights of all sentences packed into tensors of
+    shape (ngrams, dim) and (ngrams), as well as the amount of n-grams of each
+    sentence. Ragged inputs are only padded within buckets of sentences of
+    similar length.
+    """
+    if len(tokens) == 0:
+        dim = embeddings.shape[-1] if torch.is_tensor(embeddings) else 0
+        return torch.empty(0, dim), torch.empty(0), torch.zeros(0, dtype=torch.long)
+    if torch.is_tensor(embeddings):
+        return _padded_ngrams(tokens, embeddings, idf, n_gram, suffix_filter)
+
+    embedding_ngrams, idf_ngrams, lengths = [None] * len(tokens), [None] * len(tokens), [None] * len(tokens)
+    order = sorted(range(len(tokens)), key=lambda idx: len(embeddings[idx]))
+    for start in range(0, len(order), bucket_size):
+        bucket = order[start:start + bucket_size]
+        bucket_embeddings, bucket_idf, bucket_lengths = _padded_ngrams([tokens[idx] for idx in bucket],
+            pad_sequence([embeddings[idx] for idx in bucket], batch_first=True),
+            pad_sequence([idf[idx] for idx in bucket], batch_first=True), n_gram, suffix_filter)
+        for idx, embedding, weights, length in zip(bucket, bucket_embeddings.split(bucket_lengths.tolist()),
+                bucket_idf.split(bucket_lengths.tolist()), bucket_lengths):
+            embedding_ngrams[idx], idf_ngrams[idx], lengths[idx] = embedding, weights, length
+    return torch.cat(embedding_ngrams), torch.cat(idf_ngrams), torch.stack(lengths)
+
 def compute_score(src_embedding_ngrams, src_idf_ngrams, tgt_embedding_ngrams, tgt_idf_ngrams, use_cosine=False):
     embeddings = torch.cat([src_embedding_ngrams, tgt_embedding_ngrams], 0)
     embeddings.div_(torch.norm(embeddings, dim=-1).unsqueeze(-1) + 1e-30)
@@ -52,31 +103,149 @@ def compute_score(src_embedding_ngrams, src_idf_ngrams, tgt_embedding_ngrams, tg
 
     return -emd(_safe_divide(c1, np.sum(c1)), _safe_divide(c2, np.sum(c2)), distance_matrix.double().numpy())
 
-def word_mover_align(source_data, target_data, n_gram, candidates=None, use_cosine=False, suffix_filter=True):
-    src_embedding_ngrams, src_idf_ngrams = list(), list()
-    for embedding, idf, tokens in zip(*source_data):
-        embedding_ngrams, idf_ngrams = load_ngram(tokens, embedding, idf, n_gram, suffix_filter)
-        src_embedding_ngrams.append(embedding_ngrams)
-        src_idf_ngrams.append(idf_ngrams)
-
-    tgt_embedding_ngrams, tgt_idf_ngrams = list(), list()
-    for embedding, idf, tokens in zip(*target_data):
-        embedding_ngrams, idf_ngrams = load_ngram(tokens, embedding, idf, n_gram, suffix_filter)
-        tgt_embedding_ngrams.append(embedding_ngrams)
-        tgt_idf_ngrams.append(idf_ngrams)
-
-    pairs, scores = list(), list()
-    for src_index in range(len(src_embedding_ngrams)):
+def sinkhorn_score(src_embedding_ngrams, src_idf_ngrams, tgt_embedding_ngrams, tgt_idf_ngrams, use_cosine=False,
+        reg=0.01, iterations=100):
+    """
+    Entropic-regularised approximation of compute_score for a whole batch of
+    sentence pairs. Expects padded embeddings of shape (batch, ngrams, dim) and
+    idf weights of shape (batch, ngrams), where padded n-grams have a weight of
+    zero.
+    """
+    src_embeddings = src_embedding_ngrams / (torch.norm(src_embedding_ngrams, dim=-1, keepdim=True) + 1e-30)
+    tgt_embeddings = tgt_embedding_ngrams / (torch.norm(tgt_embedding_ngrams, dim=-1, keepdim=True) + 1e-30)
+    similarity = torch.bmm(src_embeddings, tgt_embeddings.transpose(1, 2))
+    if use_cosine:
+        cost = 1 - similarity
+    else:
+        src_norm = (src_embeddings**2).sum(-1).unsqueeze(-1)
+        tgt_norm = (tgt_embeddings**2).sum(-1).unsqueeze(-2)
+        cost = torch.clamp(src_norm + tgt_norm - 2.0 * similarity, 0.0, np.inf)
+
+    # log-domain iterations are numerically stable for small regularization values
+    log_src = torch.log(_safe_divide(src_idf_ngrams, src_idf_ngrams.sum(1, keepdim=True)) + 1e-30)
+    log_tgt = torch.log(_safe_divide(tgt_idf_ngrams, tgt_idf_ngrams.sum(1, keepdim=True)) + 1e-30)
+    f, g = torch.zeros_like(log_src), torch.zeros_like(log_tgt)
+    for _ in range(iterations):
+        f = reg * (log_src - torch.logsumexp((g.unsqueeze(1) - cost) / reg, dim=2))
+        g = reg * (log_tgt - torch.logsumexp((f.unsqueeze(2) - cost) / reg, dim=1))
+    transport = torch.exp((f.unsqueeze(2) + g.unsqueeze(1) - cost) / reg)
+
+    return -(transport * cost).sum((1, 2))
+
+def _sinkhorn_scores(src_embeddings, src_idf, tgt_embeddings, tgt_idf, use_cosine, reg, iterations, batch_size, device):
+    scores = list()
+    for idx in range(0, len(src_embeddings), batch_size):
+        # n-grams are only padded to the longest sentence of each batch
+        scores.extend(sinkhorn_score(*(pad_sequence(ngrams[idx:idx + batch_size], batch_first=True).to(device)
+            for ngrams in (src_embeddings, src_idf, tgt_embeddings, tgt_idf)), use_cosine, reg, iterations).tolist())
+    return scores
+
+def batched_sinkhorn_score(src_embedding_ngrams, src_idf_ngrams, src_lengths, tgt_embedding_ngrams, tgt_idf_ngrams,
+        tgt_lengths, use_cosine=False, batch_size=256, device="cpu", reg=0.01, iterations=100):
+    return _sinkhorn_scores(*_unpack_ngrams(src_embedding_ngrams, src_idf_ngrams, src_lengths),
+            *_unpack_ngrams(tgt_embedding_ngrams, tgt_idf_ngrams, tgt_lengths), use_cosine, reg, iterations, batch_size,
+            device)
+
+def _unpack_ngrams(embedding_ngrams, idf_ngrams, lengths):
+    return embedding_ngrams.split(lengths.tolist()), idf_ngrams.split(lengths.tolist())
+
+def centroid_distance(src_centroids, tgt_centroids, use_cosine=False):
+    """
+    Word Centroid Distance between idf-weighted centroids of normalized n-gram
+    embeddings. Since both distance functions used by compute_score are convex,
+    this is a lower bound of the negated score.
+    """
+    distance = ((src_centroids - tgt_centroids)**2).sum(-1)
+    return distance / 2 if use_cosine else distance
+
+def relaxed_distance(src_embedding_ngrams, src_idf_ngrams, tgt_embedding_ngrams, tgt_idf_ngrams, use_cosine=False):
+    """
+    Relaxed Word Mover's Distance, i.e., a lower bound of the negated score
+    returned by compute_score, which is tighter than the centroid distance.
+    """
+    src_embeddings = src_embedding_ngrams / (torch.norm(src_embedding_ngrams, dim=-1, keepdim=True) + 1e-30)
+    tgt_embeddings = tgt_embedding_ngrams / (torch.norm(tgt_embedding_ngrams, dim=-1, keepdim=True) + 1e-30)
+    if use_cosine:
+        distance_matrix = 1 - torch.mm(src_embeddings, tgt_embeddings.T)
+    else:
+        distance_matrix = pairwise_distances(src_embeddings, tgt_embeddings)
+
+    src_weights = _safe_divide(torch.tensor(src_idf_ngrams), sum(src_idf_ngrams))
+    tgt_weights = _safe_divide(torch.tensor(tgt_idf_ngrams), sum(tgt_idf_ngrams))
+    src_distance = (src_weights * distance_matrix.min(1).values).sum()
+    tgt_distance = (tgt_weights * distance_matrix.min(0).values).sum()
+    return max(src_distance, tgt_distance).item()
+
+def _centroids(embedding_ngrams, idf_ngrams, lengths):
+    segments = torch.repeat_interleave(torch.arange(len(lengths)), lengths)
+    weights = _safe_divide(idf_ngrams, torch.zeros(len(lengths)).index_add_(0, segments, idf_ngrams)[segments])
+    weighted = weights.unsqueeze(-1) * embedding_ngrams / (torch.norm(embedding_ngrams, dim=-1, keepdim=True) + 1e-30)
+    return torch.zeros(len(lengths), embedding_ngrams.shape[-1]).index_add_(0, segments, weighted)
+
+# worker processes are expensive to start, so they are shared by all word_mover_align calls
+_pool, _pool_workers = None, 0
+
+def _init_worker():
+    torch.set_num_threads(1)
+
+def close_worker_pool():
+    """
+    Shuts down the worker processes of word_mover_align, if there are any.
+    """
+    global _pool, _pool_workers
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+    _pool, _pool_workers = None, 0
+
+def worker_pool(num_workers):
+    """
+    Returns a process pool with num_workers workers for word_mover_align,
+    which is created once and reused by later calls.
+    """
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != num_workers:
+        close_worker_pool()
+        _pool, _pool_workers = Pool(num_workers, initializer=_init_worker), num_workers
+    return _pool
+
+# don't let the worker processes outlive the interpreter
+atexit.register(close_worker_pool)
+
+def _align_shard(src_indices, data):
+    src_embedding_ngrams, src_idf_ngrams, src_lengths, src_centroids, tgt_embedding_ngrams, tgt_idf_ngrams, \
+            tgt_lengths, tgt_centroids, candidates, use_cosine, prune = data
+    src_offsets, tgt_offsets = (src_lengths.cumsum(0) - src_lengths).tolist(), (tgt_lengths.cumsum(0) - tgt_lengths).tolist()
+    src_lengths, tgt_lengths = src_lengths.tolist(), tgt_lengths.tolist()
+
+    pairs, scores, computed = list(), list(), 0
+    for src_index in src_indices.tolist():
         best_score = float("-inf")
         best_tgt_index = -1
+        src_slice = slice(src_offsets[src_index], src_offsets[src_index] + src_lengths[src_index])
+        batch_src_embedding_ngrams = src_embedding_ngrams[src_slice]
+        batch_src_idf_ngrams = src_idf_ngrams[src_slice].tolist()
         # use only the nearest neighbors, when they are provided
-        for tgt_index in range(len(tgt_embedding_ngrams)) if candidates is None else candidates[src_index]:
-            batch_src_embedding_ngrams = src_embedding_ngrams[src_index]
-            batch_src_idf_ngrams = src_idf_ngrams[src_index]
-            batch_tgt_embedding_ngrams = tgt_embedding_ngrams[tgt_index]
-            batch_tgt_idf_ngrams = tgt_idf_ngrams[tgt_index]
+        tgt_indices = list(range(len(tgt_lengths))) if candidates is None else candidates[src_index].tolist()
+        if prune:
+            # visit candidates in order of their lower bounds, so that we can stop early (Kusner et al., 2015)
+            bounds = centroid_distance(src_centroids[src_index], tgt_centroids[tgt_indices], use_cosine)
+            order = bounds.argsort().tolist()
+            tgt_indices, bounds = [tgt_indices[idx] for idx in order], bounds[order].tolist()
+
+        for position, tgt_index in enumerate(tgt_indices):
+            tgt_slice = slice(tgt_offsets[tgt_index], tgt_offsets[tgt_index] + tgt_lengths[tgt_index])
+            batch_tgt_embedding_ngrams = tgt_embedding_ngrams[tgt_slice]
+            batch_tgt_idf_ngrams = tgt_idf_ngrams[tgt_slice].tolist()
+            if prune:
+                if bounds[position] >= -best_score:
+                    break
+                if relaxed_distance(batch_src_embedding_ngrams, batch_src_idf_ngrams, batch_tgt_embedding_ngrams,
+                        batch_tgt_idf_ngrams, use_cosine) >= -best_score:
+                    continue
             score = compute_score(batch_src_embedding_ngrams, batch_src_idf_ngrams,
                     batch_tgt_embedding_ngrams, batch_tgt_idf_ngrams, use_cosine)
+            computed += 1
             if score > best_score:
                 best_score = score
                 best_tgt_index = tgt_index
@@ -84,23 +253,75 @@ def word_mover_align(source_data, target_data, n_gram, candidates=None, use_cosi
         pairs.append((src_index, best_tgt_index))
         scores.append(best_score)
 
+    return pairs, scores, computed
+
+def _sinkhorn_align(src_embedding_ngrams, src_idf_ngrams, src_lengths, tgt_embedding_ngrams, tgt_idf_ngrams,
+        tgt_lengths, candidates, use_cosine, reg, iterations, batch_size, device):
+    src_embeddings, src_idf = _unpack_ngrams(src_embedding_ngrams, src_idf_ngrams, src_lengths)
+    tgt_embeddings, tgt_idf = _unpack_ngrams(tgt_embedding_ngrams, tgt_idf_ngrams, tgt_lengths)
+    if candidates is None:
+        candidates = np.tile(np.arange(len(tgt_lengths)), (len(src_lengths), 1))
+    candidates = np.asarray(candidates)
+    # all pairs of source sentences and their candidates are scored in batches
+    src_indices, tgt_indices = np.repeat(np.arange(len(src_lengths)), candidates.shape[1]), candidates.flatten()
+    scores = np.array(_sinkhorn_scores([src_embeddings[idx] for idx in src_indices], [src_idf[idx] for idx in src_indices],
+        [tgt_embeddings[idx] for idx in tgt_indices], [tgt_idf[idx] for idx in tgt_indices], use_cosine, reg, iterations,
+        batch_size, device)).reshape(candidates.shape)
+    best = scores.argmax(axis=1)
+    rows = np.arange(len(src_lengths))
+    return list(zip(rows.tolist(), candidates[rows, best].tolist())), scores[rows, best].tolist()
+
+def word_mover_align(source_data, target_data, n_gram, candidates=None, use_cosine=False, suffix_filter=True,
+        num_workers=1, prune=False, pool=None, solver="emd", device="cpu", sinkhorn_reg=0.01, sinkhorn_iterations=100,
+        sinkhorn_batch_size=256):
+    embeddings, idf, tokens = source_data
+    src_embedding_ngrams, src_idf_ngrams, src_lengths = load_ngrams(tokens, embeddings, idf, n_gram, suffix_filter)
+    embeddings, idf, tokens = target_data
+    tgt_embedding_ngrams, tgt_idf_ngrams, tgt_lengths = load_ngrams(tokens, embeddings, idf, n_gram, suffix_filter)
+    if solver == "sinkhorn":
+        return _sinkhorn_align(src_embedding_ngrams, src_idf_ngrams, src_lengths, tgt_embedding_ngrams, tgt_idf_ngrams,
+                tgt_lengths, candidates, use_cosine, sinkhorn_reg, sinkhorn_iterations, sinkhorn_batch_size, device)
+    src_centroids = _centroids(src_embedding_ngrams, src_idf_ngrams, src_lengths) if prune else None
+    tgt_centroids = _centroids(tgt_embedding_ngrams, tgt_idf_ngrams, tgt_lengths) if prune else None
+    data = [src_embedding_ngrams, src_idf_ngrams, src_lengths, src_centroids, tgt_embedding_ngrams, tgt_idf_ngrams,
+            tgt_lengths, tgt_centroids, None if candidates is None else torch.as_tensor(candidates), use_cosine, prune]
+    src_indices = np.arange(len(src_lengths))
+
+    if num_workers <= 1:
+        pairs, scores, computed = _align_shard(src_indices, data)
+    else:
+        # workers receive handles to shared memory instead of pickled copies of the n-grams
+        for tensor in data:
+            if torch.is_tensor(tensor):
+                tensor.share_memory_()
+        pairs, scores, computed = list(), list(), 0
+        pool = pool or worker_pool(num_workers)
+        for shard_pairs, shard_scores, shard_computed in pool.starmap(_align_shard,
+                ((shard, data) for shard in np.array_split(src_indices, 4 * num_workers))):
+            pairs.extend(shard_pairs)
+            scores.extend(shard_scores)
+            computed += shard_computed
+
+    if prune:
+        total = len(src_indices) * (len(tgt_lengths) if candidates is None else candidates.shape[1])
+        logging.info(f"Pruning saved {total - computed} of {total} exact Word Mover's Distance computations.")
     return pairs, scores
 
-def word_mover_score(source_data, target_data, n_gram, use_cosine=False, suffix_filter=True):
-    src_embedding_ngrams, src_idf_ngrams = list(), list()
-    for embedding, idf, tokens in zip(*source_data):
-        embedding_ngrams, idf_ngrams = load_ngram(tokens, embedding, idf, n_gram, suffix_filter)
-        src_embedding_ngrams.append(embedding_ngrams)
-        src_idf_ngrams.append(idf_ngrams)
+def word_mover_score(source_data, target_data, n_gram, use_cosine=False, suffix_filter=True, solver="emd", device="cpu",
+        sinkhorn_reg=0.01, sinkhorn_iterations=100, sinkhorn_batch_size=256):
+    embeddings, idf, tokens = source_data
+    src_embedding_ngrams, src_idf_ngrams, src_lengths = load_ngrams(tokens, embeddings, idf, n_gram, suffix_filter)
+    embeddings, idf, tokens = target_data
+    tgt_embedding_ngrams, tgt_idf_ngrams, tgt_lengths = load_ngrams(tokens, embeddings, idf, n_gram, suffix_filter)
 
-    tgt_embedding_ngrams, tgt_idf_ngrams = list(), list()
-    for embedding, idf, tokens in zip(*target_data):
-        embedding_ngrams, idf_ngrams = load_ngram(tokens, embedding, idf, n_gram, suffix_filter)
-        tgt_embedding_ngrams.append(embedding_ngrams)
-        tgt_idf_ngrams.append(idf_ngrams)
+    if solver == "sinkhorn":
+        return batched_sinkhorn_score(src_embedding_ngrams, src_idf_ngrams, src_lengths, tgt_embedding_ngrams,
+                tgt_idf_ngrams, tgt_lengths, use_cosine, sinkhorn_batch_size, device, sinkhorn_reg, sinkhorn_iterations)
 
     scores = list()
-    for data in zip(src_embedding_ngrams, src_idf_ngrams, tgt_embedding_ngrams, tgt_idf_ngrams):
-        scores.append(compute_score(*data, use_cosine))
+    for src_embeddings, src_idf, tgt_embeddings, tgt_idf in zip(
+            *_unpack_ngrams(src_embedding_ngrams, src_idf_ngrams, src_lengths),
+            *_unpack_ngrams(tgt_embedding_ngrams, tgt_idf_ngrams, tgt_lengths)):
+        scores.append(compute_score(src_embeddings, src_idf.tolist(), tgt_embeddings, tgt_idf.tolist(), use_cosine))
 
     return scores
@@ -1,5 +1,6 @@
 from .utils.embed import vecmap_embed, map_multilingual_embeddings
 from .utils.knn import ratio_margin_align
+from .utils.cache import EmbeddingCache
 from torch.nn.functional import cosine_similarity
 from .common import CommonScore
 from torch.cuda import is_available as cuda_is_available
@@ -13,7 +14,12 @@ class VecMapScore(CommonScore):
         tgt_lang="de",
         batch_size=5000,
         knn_batch_size = 1000000,
-        k = 5
+        k = 5,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
+        vocab_size = None
     ):
         self.device = device
         self.src_lang = src_lang
@@ -21,6 +27,11 @@ class VecMapScore(CommonScore):
         self.batch_size = batch_size
         self.knn_batch_size = knn_batch_size
         self.k = k
+        self.knn_index = knn_index
+        self.knn_params = knn_params
+        self.knn_joint = knn_joint
+        self.embedding_cache = EmbeddingCache() if cache_embeddings else None
+        self.vocab_size = vocab_size
         self.src_dict = None
         self.tgt_dict = None
 
@@ -28,19 +39,25 @@ class VecMapScore(CommonScore):
         if self.src_dict is None or self.tgt_dict is None:
             logging.info("Obtaining cross-lingual word embedding mappings from fasttext embeddings.")
             self.src_dict, self.tgt_dict = map_multilingual_embeddings(self.src_lang, self.tgt_lang,
-                self.batch_size, self.device)
+                self.batch_size, self.device, self.vocab_size)
 
-        src_embeddings, *_, src_mask = vecmap_embed(source_sents, self.src_dict, self.src_lang)
-        tgt_embeddings, *_, tgt_mask = vecmap_embed(target_sents, self.tgt_dict, self.tgt_lang)
-        source_sent_embeddings = torch.sum(src_embeddings * src_mask, 1) / torch.sum(src_mask, 1)
-        target_sent_embeddings = torch.sum(tgt_embeddings * tgt_mask, 1) / torch.sum(tgt_mask, 1)
+        if self.embedding_cache is not None:
+            return (
+                self.embedding_cache.embed(source_sents, lambda sents: self._pool(sents, self.src_dict, self.src_lang),
+                    self.src_dict.key),
+                self.embedding_cache.embed(target_sents, lambda sents: self._pool(sents, self.tgt_dict, self.tgt_lang),
+                    self.tgt_dict.key))
+        return self._pool(source_sents, self.src_dict, self.src_lang), self._pool(target_sents, self.tgt_dict, self.tgt_lang)
 
-        return source_sent_embeddings, target_sent_embeddings
+    def _pool(self, sents, lang_dict, lang):
+        embeddings, *_, mask = vecmap_embed(sents, lang_dict, lang)
+        return torch.sum(embeddings * mask, 1) / torch.sum(mask, 1)
 
     def align(self, source_sents, target_sents):
         source_embeddings, target_embeddings = self._embed(source_sents, target_sents)
         indeces, scores = ratio_margin_align(source_embeddings, target_embeddings, self.k,
-                self.knn_batch_size, self.device)
+                self.knn_batch_size, self.device, index_type=self.knn_index,
+                search_params=self.knn_params, joint=self.knn_joint)
 
         sent_pairs = [(source_sents[src_idx], target_sents[tgt_idx]) for src_idx, tgt_idx in indeces]
         return sent_pairs, scores
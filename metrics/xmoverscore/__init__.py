@@ -16,11 +16,27 @@ class XMoverBertAlignScore(XMoverAlign, BertRemap):
         remap_size = 2000,
         embed_batch_size = 128,
         knn_batch_size = 1000000,
-        align_batch_size = 5000
+        align_batch_size = 5000,
+        wmd_solver = "emd",
+        num_workers = 1,
+        prune = False,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
+        embed_max_tokens = None,
+        sinkhorn_reg = 0.01,
+        sinkhorn_iterations = 100,
+        sinkhorn_batch_size = 256,
+        fast_align_chunk_size = None,
+        fast_align_workers = 1
     ):
         logging.info("Using device \"%s\" for computations.", device)
-        XMoverAlign.__init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size)
-        BertRemap.__init__(self, model_name, None, mapping, device, do_lower_case, remap_size, embed_batch_size, alignment)
+        XMoverAlign.__init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size, wmd_solver,
+                num_workers, prune, knn_index, knn_params, knn_joint, cache_embeddings, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
+        BertRemap.__init__(self, model_name, None, mapping, device, do_lower_case, remap_size, embed_batch_size, alignment,
+                embed_max_tokens, fast_align_chunk_size=fast_align_chunk_size, fast_align_workers=fast_align_workers)
 
 class XMoverVecMapAlignScore(XMoverAlign, VecMapEmbed):
     def __init__(
@@ -33,11 +49,24 @@ class XMoverVecMapAlignScore(XMoverAlign, VecMapEmbed):
         src_lang = "de",
         tgt_lang = "en",
         batch_size = 5000,
-        align_batch_size = 5000
+        align_batch_size = 5000,
+        wmd_solver = "emd",
+        num_workers = 1,
+        prune = False,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
+        vocab_size = None,
+        sinkhorn_reg = 0.01,
+        sinkhorn_iterations = 100,
+        sinkhorn_batch_size = 256
     ):
         logging.info("Using device \"%s\" for computations.", device)
-        XMoverAlign.__init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size)
-        VecMapEmbed.__init__(self, device, src_lang, tgt_lang, batch_size)
+        XMoverAlign.__init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size, wmd_solver,
+                num_workers, prune, knn_index, knn_params, knn_joint, cache_embeddings, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
+        VecMapEmbed.__init__(self, device, src_lang, tgt_lang, batch_size, vocab_size)
 
 class XMoverNMTBertAlignScore(XMoverNMTAlign, BertRemap):
     def __init__(
@@ -62,12 +91,28 @@ class XMoverNMTBertAlignScore(XMoverNMTAlign, BertRemap):
         embed_batch_size = 128,
         translate_batch_size = 16,
         nmt_weights = [0.8, 0.2],
+        wmd_solver = "emd",
+        num_workers = 1,
+        prune = False,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
+        embed_max_tokens = None,
+        sinkhorn_reg = 0.01,
+        sinkhorn_iterations = 100,
+        sinkhorn_batch_size = 256,
+        fast_align_chunk_size = None,
+        fast_align_workers = 1
     ):
         logging.info("Using device \"%s\" for computations.", device)
         XMoverNMTAlign.__init__(self, device, k, n_gram, knn_batch_size, train_size, align_batch_size, src_lang,
-                tgt_lang, mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size)
+                tgt_lang, mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size, wmd_solver,
+                num_workers, prune, knn_index, knn_params, knn_joint, cache_embeddings, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
         BertRemap.__init__(self, model_name, monolingual_model_name, mapping, device, do_lower_case, remap_size,
-                embed_batch_size, alignment)
+                embed_batch_size, alignment, embed_max_tokens, fast_align_chunk_size=fast_align_chunk_size,
+                fast_align_workers=fast_align_workers)
 
 class XMoverNMTLMBertAlignScore(XMoverNMTLMAlign, BertRemap):
     def __init__(
@@ -95,12 +140,30 @@ class XMoverNMTLMBertAlignScore(XMoverNMTLMAlign, BertRemap):
         remap_size = 2000,
         embed_batch_size = 128,
         translate_batch_size = 16,
+        wmd_solver = "emd",
+        num_workers = 1,
+        prune = False,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
+        embed_max_tokens = None,
+        lm_batch_size = None,
+        lm_stride = None,
+        sinkhorn_reg = 0.01,
+        sinkhorn_iterations = 100,
+        sinkhorn_batch_size = 256,
+        fast_align_chunk_size = None,
+        fast_align_workers = 1
     ):
         logging.info("Using device \"%s\" for computations.", device)
         XMoverNMTLMAlign.__init__(self, device, k, n_gram, knn_batch_size, train_size, align_batch_size, src_lang, tgt_lang,
-                mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size, use_lm, lm_weights, lm_model_name)
+                mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size, use_lm, lm_weights, lm_model_name,
+                wmd_solver, num_workers, prune, knn_index, knn_params, knn_joint, cache_embeddings, lm_batch_size, lm_stride,
+                sinkhorn_reg=sinkhorn_reg, sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
         BertRemap.__init__(self, model_name, monolingual_model_name, mapping, device, do_lower_case, remap_size,
-                embed_batch_size, alignment)
+                embed_batch_size, alignment, embed_max_tokens, fast_align_chunk_size=fast_align_chunk_size,
+                fast_align_workers=fast_align_workers)
 
 class XMoverScore(XMoverLMAlign, BertRemapPretrained):
     """
@@ -123,9 +186,25 @@ class XMoverScore(XMoverLMAlign, BertRemapPretrained):
         embed_batch_size = 128,
         knn_batch_size = 1000000,
         align_batch_size = 5000,
-        lm_weights = [1, 0.1]
+        lm_weights = [1, 0.1],
+        wmd_solver = "emd",
+        num_workers = 1,
+        prune = False,
+        knn_index = "Flat",
+        knn_params = "",
+        knn_joint = False,
+        cache_embeddings = False,
+        embed_max_tokens = None,
+        lm_batch_size = None,
+        lm_stride = None,
+        sinkhorn_reg = 0.01,
+        sinkhorn_iterations = 100,
+        sinkhorn_batch_size = 256
     ):
         logging.info("Using device \"%s\" for computations.", device)
         XMoverLMAlign.__init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size, use_lm,
-                lm_weights, lm_model_name)
-        BertRemapPretrained.__init__(self, model_name, None, mapping, device, do_lower_case, embed_batch_size)
+                lm_weights, lm_model_name, wmd_solver, num_workers, prune, knn_index, knn_params, knn_joint,
+                cache_embeddings, lm_batch_size, lm_stride, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
+        BertRemapPretrained.__init__(self, model_name, None, mapping, device, do_lower_case, embed_batch_size,
+                embed_max_tokens)
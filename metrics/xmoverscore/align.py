@@ -1,5 +1,6 @@
-from ..utils.wmd import word_mover_align, word_mover_score
+from ..utils.wmd import word_mover_align, word_mover_score, worker_pool
 from ..utils.knn import wcd_align, ratio_margin_align, cosine_align
+from ..utils.cache import EmbeddingCache
 from ..utils.nmt import train, translate
 from ..utils.perplexity import lm_perplexity
 from ..utils.env import DATADIR
@@ -15,38 +16,59 @@ import logging
 import torch
 
 class XMoverAlign(CommonScore):
-    def __init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size):
+    def __init__(self, device, k, n_gram, knn_batch_size, use_cosine, align_batch_size, wmd_solver="emd", num_workers=1,
+            prune=False, knn_index="Flat", knn_params="", knn_joint=False, cache_embeddings=False, sinkhorn_reg=0.01,
+            sinkhorn_iterations=100, sinkhorn_batch_size=256):
         self.device = device
         self.k = k
         self.n_gram = n_gram
         self.knn_batch_size = knn_batch_size
         self.use_cosine = use_cosine
         self.align_batch_size = align_batch_size
+        self.wmd_solver = wmd_solver
+        self.num_workers = num_workers
+        self.prune = prune
+        self.knn_index = knn_index
+        self.knn_params = knn_params
+        self.knn_joint = knn_joint
+        self.embedding_cache = EmbeddingCache() if cache_embeddings else None
+        self.sinkhorn_reg = sinkhorn_reg
+        self.sinkhorn_iterations = sinkhorn_iterations
+        self.sinkhorn_batch_size = sinkhorn_batch_size
 
     def _mean_pool_embed(self, source_sents, target_sents):
-        source_sent_embeddings, target_sent_embeddings, idx = None, None, 0
-        while idx < max(len(source_sents), len(target_sents)):
-            src_embeddings, _, _, src_mask, tgt_embeddings, _, _, tgt_mask = self._embed(
-                source_sents[idx:idx + self.align_batch_size], target_sents[idx:idx + self.align_batch_size])
-            if source_sent_embeddings is None and target_sent_embeddings is None:
-                source_sent_embeddings = torch.empty(len(source_sents), src_embeddings.shape[-1])
-                target_sent_embeddings = torch.empty(len(target_sents), tgt_embeddings.shape[-1])
-            source_sent_embeddings[idx:idx + len(src_embeddings)] = torch.sum(src_embeddings * src_mask, 1) / torch.sum(src_mask, 1)
-            target_sent_embeddings[idx:idx + len(tgt_embeddings)] = torch.sum(tgt_embeddings * tgt_mask, 1) / torch.sum(tgt_mask, 1)
-            idx += self.align_batch_size
-
-        return source_sent_embeddings, target_sent_embeddings
+        if self.embedding_cache is not None:
+            return (
+                self.embedding_cache.embed(source_sents, lambda sents: self._chunked_pool_embed(sents, [])[0],
+                    *self._model_identity(source=True)),
+                self.embedding_cache.embed(target_sents, lambda sents: self._chunked_pool_embed([], sents)[1],
+                    *self._model_identity(source=False)))
+        return self._chunked_pool_embed(source_sents, target_sents)
+
+    def _chunked_pool_embed(self, source_sents, target_sents):
+        source_sent_embeddings, target_sent_embeddings = list(), list()
+        for idx in range(0, max(len(source_sents), len(target_sents)), self.align_batch_size):
+            src_embeddings, tgt_embeddings = self._embed_pooled(source_sents[idx:idx + self.align_batch_size],
+                    target_sents[idx:idx + self.align_batch_size])
+            source_sent_embeddings.append(src_embeddings)
+            target_sent_embeddings.append(tgt_embeddings)
+
+        return torch.cat(source_sent_embeddings), torch.cat(target_sent_embeddings)
 
     def _memory_efficient_word_mover_align(self, source_sents, target_sents, candidates):
         pairs, scores, idx, k = list(), list(), 0, candidates.shape[1]
         batch_size = ceil(self.align_batch_size / k)
+        # all chunks share the same worker processes
+        pool = worker_pool(self.num_workers) if self.num_workers > 1 else None
         while idx < len(source_sents):
             src_embeddings, src_idf, src_tokens, _, tgt_embeddings, tgt_idf, tgt_tokens, _ = self._embed(
                 source_sents[idx:idx + batch_size],
                 [target_sents[candidate] for candidate in candidates[idx:idx + batch_size].flatten()])
             batch_pairs, batch_scores = word_mover_align((src_embeddings, src_idf, src_tokens),
                 (tgt_embeddings, tgt_idf, tgt_tokens), self.n_gram,
-                arange(len(src_embeddings) * k).reshape(len(src_embeddings), k))
+                arange(len(src_embeddings) * k).reshape(len(src_embeddings), k), num_workers=self.num_workers,
+                prune=self.prune, pool=pool, solver=self.wmd_solver, device=self.device, sinkhorn_reg=self.sinkhorn_reg,
+                sinkhorn_iterations=self.sinkhorn_iterations, sinkhorn_batch_size=self.sinkhorn_batch_size)
             pairs.extend([(src + idx, candidates[idx:idx + batch_size].flatten()[tgt]) for src, tgt in batch_pairs])
             scores.extend(batch_scores)
             idx += batch_size
@@ -59,10 +81,11 @@ class XMoverAlign(CommonScore):
         logging.info("Searching for nearest neighbors.")
         if self.use_cosine:
             candidates, _ = cosine_align(source_sent_embeddings, target_sent_embeddings, self.k,
-                    self.knn_batch_size, self.device)
+                    self.knn_batch_size, self.device, index_type=self.knn_index, search_params=self.knn_params,
+                    joint=self.knn_joint)
         else:
             candidates, _ = wcd_align(source_sent_embeddings, target_sent_embeddings, self.k,
-                    self.knn_batch_size, self.device)
+                    self.knn_batch_size, self.device, index_type=self.knn_index, search_params=self.knn_params)
 
         logging.info("Filter best nearest neighbors with Word Mover's Distance.")
         pairs, scores = self._memory_efficient_word_mover_align(source_sents, target_sents, candidates)
@@ -73,7 +96,8 @@ class XMoverAlign(CommonScore):
         src_embeddings, src_idf, src_tokens, _, tgt_embeddings, tgt_idf, tgt_tokens, _ = self._embed(source_sents,
                 target_sents, same_language)
         scores = word_mover_score((src_embeddings, src_idf, src_tokens), (tgt_embeddings, tgt_idf, tgt_tokens),
-                self.n_gram)
+                self.n_gram, solver=self.wmd_solver, device=self.device, sinkhorn_reg=self.sinkhorn_reg,
+                sinkhorn_iterations=self.sinkhorn_iterations, sinkhorn_batch_size=self.sinkhorn_batch_size)
         return scores
 
 class XMoverLMAlign(XMoverAlign):
@@ -81,12 +105,18 @@ class XMoverLMAlign(XMoverAlign):
     Extends XMoverScore based sentence aligner with an additional language model.
     """
 
-    def __init__(self, device, k, n_gram, knn_batch_size, align_batch_size, use_cosine, use_lm, lm_weights, lm_model_name):
-        super().__init__(device, k, n_gram, knn_batch_size, use_cosine, align_batch_size)
+    def __init__(self, device, k, n_gram, knn_batch_size, align_batch_size, use_cosine, use_lm, lm_weights, lm_model_name,
+            wmd_solver="emd", num_workers=1, prune=False, knn_index="Flat", knn_params="", knn_joint=False, cache_embeddings=False,
+            lm_batch_size=None, lm_stride=None, sinkhorn_reg=0.01, sinkhorn_iterations=100, sinkhorn_batch_size=256):
+        super().__init__(device, k, n_gram, knn_batch_size, use_cosine, align_batch_size, wmd_solver, num_workers, prune,
+                knn_index, knn_params, knn_joint, cache_embeddings, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
         self.device = device
         self.use_lm = use_lm
         self.lm_weights = lm_weights
         self.lm_model_name = lm_model_name
+        self.lm_batch_size = lm_batch_size
+        self.lm_stride = lm_stride
 
     #Override
     def score(self, source_sents, target_sents):
@@ -96,7 +126,7 @@ class XMoverLMAlign(XMoverAlign):
         """
         wmd_scores = super().score(source_sents, target_sents)
         if self.use_lm:
-            lm_scores = lm_perplexity(target_sents, self.device, self.lm_model_name)
+            lm_scores = lm_perplexity(target_sents, self.device, self.lm_model_name, self.lm_batch_size, self.lm_stride)
             return (self.lm_weights[0] * array(wmd_scores) + self.lm_weights[1] * array(lm_scores)).tolist()
         else:
             return wmd_scores
@@ -107,8 +137,12 @@ class XMoverNMTAlign(XMoverAlign):
     """
 
     def __init__(self, device, k, n_gram, knn_batch_size, train_size, align_batch_size, src_lang, tgt_lang,
-            mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size):
-        super().__init__(device, k, n_gram, knn_batch_size, use_cosine, align_batch_size)
+            mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size, wmd_solver="emd", num_workers=1,
+            prune=False, knn_index="Flat", knn_params="", knn_joint=False, cache_embeddings=False, sinkhorn_reg=0.01,
+            sinkhorn_iterations=100, sinkhorn_batch_size=256):
+        super().__init__(device, k, n_gram, knn_batch_size, use_cosine, align_batch_size, wmd_solver, num_workers, prune,
+                knn_index, knn_params, knn_joint, cache_embeddings, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
         self.train_size = train_size
         self.knn_batch_size = knn_batch_size
         self.src_lang = src_lang
@@ -135,7 +169,7 @@ class XMoverNMTAlign(XMoverAlign):
             return [self.nmt_weights[0] * score + self.nmt_weights[1] * mt_score for score, mt_score in zip(scores, mt_scores)]
 
     def train(self, source_sents, target_sents, suffix="data", iteration=1, aligned=False, finetune=False, overwrite=True,
-            back_translate=False, k=None):
+            back_translate=False, k=None, cache_index=False):
         mine_file, batch, batch_size = join(DATADIR, "translation", f"mined-{suffix}.json"), 0, self.mine_batch_size
         pairs, scores = list(), list()
         self.back_translate = back_translate
@@ -155,11 +189,12 @@ class XMoverNMTAlign(XMoverAlign):
                 if self.use_cosine:
                     logging.info("Mining pseudo parallel data with Ratio Margin function.")
                     batch_pairs, batch_scores = ratio_margin_align(source_sent_embeddings, target_sent_embeddings,
-                            self.k if k is None else k, self.knn_batch_size, self.device)
+                            self.k if k is None else k, self.knn_batch_size, self.device, cache_index, self.knn_index,
+                            self.knn_params, self.knn_joint)
                 else:
                     logging.info("Mining pseudo parallel data using Word Centroid Distance.")
                     candidates, _ = wcd_align(source_sent_embeddings, target_sent_embeddings, self.k if k is None else k,
-                            self.knn_batch_size, self.device)
+                            self.knn_batch_size, self.device, cache_index, self.knn_index, self.knn_params)
                     logging.info("Computing exact Word Mover's Distances for candidates.")
                     batch_pairs, batch_scores = self._memory_efficient_word_mover_align(batch_src, batch_tgt, candidates)
                 del source_sent_embeddings, target_sent_embeddings
@@ -220,13 +255,19 @@ class XMoverNMTLMAlign(XMoverNMTAlign):
     """
 
     def __init__(self, device, k, n_gram, knn_batch_size, train_size, align_batch_size, src_lang, tgt_lang, mt_model_name,
-            translate_batch_size, nmt_weights, use_cosine, mine_batch_size, use_lm, lm_weights, lm_model_name):
+            translate_batch_size, nmt_weights, use_cosine, mine_batch_size, use_lm, lm_weights, lm_model_name,
+            wmd_solver="emd", num_workers=1, prune=False, knn_index="Flat", knn_params="", knn_joint=False, cache_embeddings=False,
+            lm_batch_size=None, lm_stride=None, sinkhorn_reg=0.01, sinkhorn_iterations=100, sinkhorn_batch_size=256):
         super().__init__(device, k, n_gram, knn_batch_size, train_size, align_batch_size, src_lang, tgt_lang,
-                mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size)
+                mt_model_name, translate_batch_size, nmt_weights, use_cosine, mine_batch_size, wmd_solver, num_workers, prune,
+                knn_index, knn_params, knn_joint, cache_embeddings, sinkhorn_reg=sinkhorn_reg,
+                sinkhorn_iterations=sinkhorn_iterations, sinkhorn_batch_size=sinkhorn_batch_size)
         self.device = device
         self.use_lm = use_lm
         self.lm_weights = lm_weights
         self.lm_model_name = lm_model_name
+        self.lm_batch_size = lm_batch_size
+        self.lm_stride = lm_stride
 
     #Override
     def score(self, source_sents, target_sents):
@@ -237,7 +278,7 @@ class XMoverNMTLMAlign(XMoverNMTAlign):
         """
         nmt_scores = super().score(source_sents, target_sents)
         if self.use_lm:
-            lm_scores = lm_perplexity(target_sents, self.device, self.lm_model_name)
+            lm_scores = lm_perplexity(target_sents, self.device, self.lm_model_name, self.lm_batch_size, self.lm_stride)
             return (self.lm_weights[0] * array(nmt_scores) + self.lm_weights[1] * array(lm_scores)).tolist()
         else:
             return nmt_scores
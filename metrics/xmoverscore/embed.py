@@ -1,6 +1,6 @@
-from transformers import BertModel, BertTokenizer, BertConfig
-from ..utils.embed import bert_embed, vecmap_embed, map_multilingual_embeddings
-from ..utils.remap import fast_align, awesome_align, sim_align, get_aligned_features_avgbpe, clp, umd
+from transformers import BertModel, BertTokenizer
+from ..utils.embed import bert_embed, bert_pool, vecmap_embed, map_multilingual_embeddings
+from ..utils.remap import fast_align, awesome_align, sim_align, get_aligned_moments
 from ..utils.env import DATADIR
 from ..common import CommonScore
 from os.path import isfile, join
@@ -14,25 +14,25 @@ import logging
 import torch
 
 class BertEmbed(CommonScore):
-    def __init__(self, model_name, monolingual_model_name, mapping, device, do_lower_case, embed_batch_size):
+    def __init__(self, model_name, monolingual_model_name, mapping, device, do_lower_case, embed_batch_size,
+            embed_max_tokens=None):
         self.model_name = model_name
         self.monolingual_model_name = monolingual_model_name if monolingual_model_name else model_name
         self.do_lower_case = do_lower_case
         self.device = device
         self.mapping = mapping
         self.embed_batch_size = embed_batch_size
+        self.embed_max_tokens = embed_max_tokens
         self.projection = None
 
     @cached_property
     def model(self):
-        config = BertConfig.from_pretrained(self.model_name, output_hidden_states=True)
-        return BertModel.from_pretrained(self.model_name, config=config).to(self.device)
+        return BertModel.from_pretrained(self.model_name).to(self.device)
 
     @cached_property
     def monolingual_model(self):
         if self.monolingual_model_name != self.model_name:
-            config = BertConfig.from_pretrained(self.monolingual_model_name, output_hidden_states=True)
-            return BertModel.from_pretrained(self.monolingual_model_name, config=config).to(self.device)
+            return BertModel.from_pretrained(self.monolingual_model_name).to(self.device)
         else:
             return self.model
 
@@ -49,25 +49,48 @@ class BertEmbed(CommonScore):
 
     def _embed(self, source_sents, target_sents, same_language=False):
         model, tokenizer = (self.monolingual_model, self.monolingual_tokenzier) if same_language else (self.model, self.tokenizer)
-        src_embeddings, src_idf, src_tokens, src_mask = bert_embed(source_sents, self.embed_batch_size, model,
-                tokenizer, self.device)
-        tgt_embeddings, tgt_idf, tgt_tokens, tgt_mask = bert_embed(target_sents, self.embed_batch_size, model,
-                tokenizer, self.device)
+        # ragged embeddings avoid padding all sentences to the longest one
+        src_embeddings, src_idf, src_tokens, src_lengths = bert_embed(source_sents, self.embed_batch_size, model,
+                tokenizer, self.device, self.embed_max_tokens, ragged=True)
+        tgt_embeddings, tgt_idf, tgt_tokens, tgt_lengths = bert_embed(target_sents, self.embed_batch_size, model,
+                tokenizer, self.device, self.embed_max_tokens, ragged=True)
 
         if self.projection is not None and not same_language:
-            if self.mapping == 'CLP':
-                src_embeddings = torch.matmul(src_embeddings, self.projection)
-            else:
-                src_embeddings = src_embeddings - (src_embeddings * self.projection).sum(2, keepdim=True) * \
-                        self.projection.repeat(src_embeddings.shape[0], src_embeddings.shape[1], 1)
+            src_embeddings = [self._project(embeddings) for embeddings in src_embeddings]
 
-        return src_embeddings, src_idf, src_tokens, src_mask, tgt_embeddings, tgt_idf, tgt_tokens, tgt_mask
+        return src_embeddings, src_idf, src_tokens, src_lengths, tgt_embeddings, tgt_idf, tgt_tokens, tgt_lengths
+
+    #Override
+    def _embed_pooled(self, source_sents, target_sents, same_language=False):
+        model, tokenizer = (self.monolingual_model, self.monolingual_tokenzier) if same_language else (self.model, self.tokenizer)
+        src_embeddings = bert_pool(source_sents, self.embed_batch_size, model, tokenizer, self.device, self.embed_max_tokens)
+        tgt_embeddings = bert_pool(target_sents, self.embed_batch_size, model, tokenizer, self.device, self.embed_max_tokens)
+
+        # both projections are linear, so they can be applied after mean-pooling
+        if self.projection is not None and not same_language:
+            src_embeddings = self._project(src_embeddings)
+
+        return src_embeddings, tgt_embeddings
+
+    def _model_identity(self, source=True):
+        # only source embeddings are projected
+        return (self.model, self.tokenizer, self.projection, self.mapping) if source else (self.model, self.tokenizer)
+
+    def _project(self, embeddings):
+        if self.mapping == 'CLP':
+            return torch.matmul(embeddings, self.projection)
+        else:
+            return embeddings - (embeddings * self.projection).sum(-1, keepdim=True) * self.projection
 
 class BertRemap(BertEmbed):
-    def __init__(self, model_name, monolingual_model_name, mapping, device, do_lower_case, remap_size, embed_batch_size, alignment):
-        super().__init__(model_name, monolingual_model_name, mapping, device, do_lower_case, embed_batch_size)
+    def __init__(self, model_name, monolingual_model_name, mapping, device, do_lower_case, remap_size, embed_batch_size, alignment,
+            embed_max_tokens=None, fast_align_chunk_size=None, fast_align_workers=1):
+        super().__init__(model_name, monolingual_model_name, mapping, device, do_lower_case, embed_batch_size,
+                embed_max_tokens)
         self.remap_size = remap_size
         self.alignment = alignment
+        self.fast_align_chunk_size = fast_align_chunk_size
+        self.fast_align_workers = fast_align_workers
 
     def remap(self, source_sents, target_sents, suffix="tensor", aligned=False, overwrite=True, new_mapping=None):
         file_path, mapping = join(DATADIR, f"projection-{suffix}.pt"), new_mapping or self.mapping
@@ -82,26 +105,28 @@ class BertRemap(BertEmbed):
                     if edit_distance(src_sent, tgt_sent) / max(len(src_sent), len(tgt_sent)) > 0.5:
                         sorted_sent_pairs.append((src_sent, tgt_sent))
             if self.alignment == "fast":
-                tokenized_pairs, align_pairs = fast_align(sorted_sent_pairs, self.tokenizer, self.remap_size)
+                tokenized_pairs, align_pairs = fast_align(sorted_sent_pairs, self.tokenizer, self.remap_size,
+                        chunk_size=self.fast_align_chunk_size, num_workers=self.fast_align_workers)
             elif self.alignment == "sim":
-                tokenized_pairs, align_pairs = sim_align(sorted_sent_pairs, self.tokenizer, self.remap_size, self.device)
+                tokenized_pairs, align_pairs = sim_align(sorted_sent_pairs, self.tokenizer, self.remap_size, self.device,
+                        batch_size=self.embed_batch_size)
             else: # awesome
                 tokenized_pairs, align_pairs = awesome_align(sorted_sent_pairs, self.model, self.tokenizer,
-                        self.remap_size, self.device)
+                        self.remap_size, self.device, batch_size=self.embed_batch_size)
                 if self.alignment.endswith("remap"): # awesome-remap
-                    src_matrix, tgt_matrix = get_aligned_features_avgbpe(tokenized_pairs, align_pairs,
-                            self.model, self.tokenizer, self.embed_batch_size, self.device, 8)
+                    moments = get_aligned_moments(tokenized_pairs, align_pairs, self.model, self.tokenizer,
+                            self.embed_batch_size, self.device, 8)
                     tokenized_pairs, align_pairs = awesome_align(sorted_sent_pairs, self.model, self.tokenizer,
-                            self.remap_size, self.device,
-                            clp(src_matrix, tgt_matrix) if mapping == "CLP" else umd(src_matrix, tgt_matrix))
-            src_matrix, tgt_matrix = get_aligned_features_avgbpe(tokenized_pairs, align_pairs,
-                    self.model, self.tokenizer, self.embed_batch_size, self.device)
+                            self.remap_size, self.device, moments.clp() if mapping == "CLP" else moments.umd(),
+                            batch_size=self.embed_batch_size)
+            moments = get_aligned_moments(tokenized_pairs, align_pairs, self.model, self.tokenizer,
+                    self.embed_batch_size, self.device)
 
-            logging.info(f"Using {len(src_matrix)} aligned word pairs to compute projection tensor.")
+            logging.info(f"Using {moments.count} aligned word pairs to compute projection tensor.")
             if mapping == "CLP":
-                self.projection = clp(src_matrix, tgt_matrix)
+                self.projection = moments.clp()
             else:
-                self.projection = umd(src_matrix, tgt_matrix)
+                self.projection = moments.umd()
             torch.save(self.projection, file_path)
         else:
             logging.info(f'Loading {mapping} projection tensor from disk.')
@@ -135,19 +160,27 @@ class BertRemapPretrained(BertEmbed):
             raise ValueError("Language direction does not exist!")
 
 class VecMapEmbed(CommonScore):
-    def __init__(self, device, src_lang, tgt_lang, batch_size):
+    def __init__(self, device, src_lang, tgt_lang, batch_size, vocab_size=None):
         self.device = device
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.batch_size = batch_size
+        self.vocab_size = vocab_size
         self.src_dict = None
         self.tgt_dict = None
 
-    def _embed(self, source_sents, target_sents, same_language=False):
+    def _map_embeddings(self):
         if self.src_dict is None or self.tgt_dict is None:
             logging.info("Obtaining cross-lingual word embedding mappings from fasttext embeddings.")
             self.src_dict, self.tgt_dict = map_multilingual_embeddings(self.src_lang, self.tgt_lang,
-                self.batch_size, self.device)
+                self.batch_size, self.device, self.vocab_size)
+
+    def _model_identity(self, source=True):
+        self._map_embeddings()
+        return ((self.src_dict if source else self.tgt_dict).key,)
+
+    def _embed(self, source_sents, target_sents, same_language=False):
+        self._map_embeddings()
         src_embeddings, src_idf, src_tokens, src_mask = vecmap_embed(source_sents,
                 *((self.tgt_dict, self.tgt_lang) if same_language else (self.src_dict, self.src_lang)))
         tgt_embeddings, tgt_idf, tgt_tokens, tgt_mask = vecmap_embed(target_sents, self.tgt_dict, self.tgt_lang)
@@ -24,6 +24,7 @@ setup(
         "torch==1.9.0",
         "sentence-transformers==1.2.0",
         "transformers==4.10.3",
+        "filelock==3.4.2",
         "datasets==2.0.0",
         "nltk>=3.4.5",
         "sentencepiece==0.1.96",
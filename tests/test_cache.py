@@ -0,0 +1,39 @@
+import pytest
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from os.path import join
+from metrics.utils import cache
+
+def test_concurrent_writers_keep_tier_consistent(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "DATADIR", str(tmp_path))
+    hashes, embeddings = ["a", "b", "c", "d"], np.arange(12, dtype=np.float32).reshape(4, 3)
+    first, second = cache.EmbeddingCache(), cache.EmbeddingCache()
+    # both writers missed the same sentences before either of them stored them
+    first._load("key"), second._load("key")
+    first._store("key", hashes, embeddings)
+    second._store("key", hashes[2:] + ["e"], np.concatenate([embeddings[2:], [[12, 13, 14]]]))
+
+    tier = cache.EmbeddingCache()._load("key")
+    assert tier["vectors"].shape == (5, 3)
+    for text_hash, expected in zip(hashes + ["e"], np.concatenate([embeddings, [[12, 13, 14]]])):
+        assert np.array_equal(tier["vectors"][tier["index"][text_hash]], expected)
+
+def test_interrupted_append_is_discarded(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "DATADIR", str(tmp_path))
+    embeddings = np.arange(6, dtype=np.float32).reshape(2, 3)
+    cache.EmbeddingCache()._store("key", ["a", "b"], embeddings)
+    # a crash after appending a vector, but before its index line was complete
+    with open(join(tmp_path, "embeddings", "key", "vectors.f32"), "ab") as f:
+        f.write(np.ones(3, dtype=np.float32).tobytes())
+    with open(join(tmp_path, "embeddings", "key", "index.txt"), "a") as f:
+        f.write("c")
+
+    tier = cache.EmbeddingCache()._load("key")
+    assert tier["vectors"].shape == (2, 3) and set(tier["index"]) == {"a", "b"}
+
+    cache.EmbeddingCache()._store("key", ["d"], np.full((1, 3), 7, dtype=np.float32))
+    tier = cache.EmbeddingCache()._load("key")
+    assert tier["vectors"].shape == (3, 3) and set(tier["index"]) == {"a", "b", "d"}
+    assert np.array_equal(tier["vectors"][tier["index"]["d"]], [7, 7, 7])
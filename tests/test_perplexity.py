@@ -0,0 +1,62 @@
+import pytest
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from metrics.utils.perplexity import _batched_perplexity, _sliding_perplexity
+
+def test_sliding_perplexity_matches_full_context():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=100, n_positions=64, n_ctx=64, n_embd=32, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    input_ids = torch.randint(0, 100, (40,))
+
+    with torch.no_grad():
+        expected = -model(input_ids.unsqueeze(0), labels=input_ids.unsqueeze(0))[0].item()
+        # the first window leaves a cache shorter than the context, which must be kept entirely
+        actual = _sliding_perplexity(input_ids, model, "cpu", stride=20, max_len=48)
+
+    assert actual == pytest.approx(expected, abs=1e-5)
+
+def test_sliding_perplexity_approximates_exact_windows():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=100, n_positions=32, n_ctx=32, n_embd=32, n_layer=2, n_head=2,
+        initializer_range=0.2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    input_ids, stride, max_len = torch.randint(0, 100, (100,)), 8, 32
+
+    with torch.no_grad():
+        # recompute each chunk from scratch with the max_len - stride preceding tokens as context
+        losses = list()
+        for start in range(0, len(input_ids), stride):
+            context = min(start, max_len - stride)
+            window = input_ids[start - context:start + stride]
+            # the first token of the sequence has no prediction
+            logits, first = model(window.unsqueeze(0)).logits[0], max(1, context)
+            losses.append(torch.nn.functional.cross_entropy(logits[first - 1:-1], window[first:], reduction="none"))
+        expected = -torch.cat(losses).mean().item()
+        # the cache is truncated, so the keys and values of the context are reused instead of recomputed
+        actual = _sliding_perplexity(input_ids, model, "cpu", stride, max_len)
+
+    assert actual == pytest.approx(expected, abs=2e-2)
+
+class WhitespaceTokenizer():
+    def tokenize(self, text):
+        return text.split()
+
+    def convert_tokens_to_ids(self, tokens):
+        return [int(token) for token in tokens]
+
+def test_batched_perplexity_matches_unbatched():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=100, n_positions=64, n_ctx=64, n_embd=32, n_layer=2, n_head=2)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    hyps = [" ".join(str(token) for token in torch.randint(0, 100, (length,)).tolist()) for length in (5, 1, 17, 9, 30)]
+
+    with torch.no_grad():
+        expected = list()
+        for hyp in hyps:
+            input_ids = torch.tensor([[int(token) for token in hyp.split()]])
+            expected.append(-model(input_ids, labels=input_ids)[0].item() if input_ids.shape[1] > 1 else 0)
+        actual = _batched_perplexity(hyps, model, WhitespaceTokenizer(), "cpu", batch_size=2)
+
+    assert actual == pytest.approx(expected, abs=1e-5)